@@ -14,14 +14,127 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
+
+from charmhelpers.core import hookenv, unitdata
 from charms import reactive
 from charms.reactive import when, when_not
 
 
+# Version of the payload in the topology relation key. Must match
+# TOPOLOGY_PROTOCOL in requires.py
+TOPOLOGY_PROTOCOL = 3
+
+
+class ClientRequests(object):
+    """Indexes of what client relations have requested.
+
+    Maps each requested value of the database, roles, extensions and
+    egress-subnets settings to the relation ids requesting it, and each
+    relation id to its requested values. List settings are split, so
+    a client requesting roles 'a,b' is found under both.
+
+    Relations are only reindexed when their data has changed since the
+    previous hook, using a fingerprint of their raw data stored in the
+    unit's key/value store.
+    """
+    fields = ('database', 'roles', 'extensions', 'egress-subnets')
+
+    def __init__(self):
+        self._by_relid = {}
+        self._by_value = {field: {} for field in self.fields}
+        self._fingerprints = {}
+
+    def relids(self, field, value):
+        """frozenset of relation ids requesting value for field."""
+        return frozenset(self._by_value[field].get(value, ()))
+
+    def values(self, field, relid=None):
+        """frozenset of values requested for field.
+
+        If relid is given, only those requested by that relation.
+        """
+        if relid is None:
+            return frozenset(self._by_value[field].keys())
+        return self._by_relid.get(relid, {}).get(field, frozenset())
+
+    def __contains__(self, relid):
+        return relid in self._by_relid
+
+    def __iter__(self):
+        return iter(sorted(self._by_relid))
+
+    def _update(self, relid, values, fingerprint):
+        self._remove(relid)
+        self._by_relid[relid] = values
+        self._fingerprints[relid] = fingerprint
+        for field, vals in values.items():
+            index = self._by_value[field]
+            for v in vals:
+                index.setdefault(v, set()).add(relid)
+
+    def _remove(self, relid):
+        old = self._by_relid.pop(relid, None)
+        self._fingerprints.pop(relid, None)
+        if old is None:
+            return
+        for field, vals in old.items():
+            index = self._by_value[field]
+            for v in vals:
+                index[v].discard(relid)
+                if not index[v]:
+                    del index[v]
+
+    def refresh(self, relations):
+        """Reindex relations whose data changed, and drop departed ones.
+
+        :returns: sorted list of relation ids that were reindexed or dropped.
+        """
+        changed = []
+        seen = set()
+        for relation in relations:
+            relid = relation.relation_id
+            seen.add(relid)
+            raw = [(unit.unit_name, [unit.received_raw.get(f) or '' for f in self.fields])
+                   for unit in relation.joined_units]
+            fingerprint = hashlib.sha1(json.dumps(raw).encode('UTF-8')).hexdigest()
+            if self._fingerprints.get(relid) == fingerprint:
+                continue
+            values = {f: frozenset(v for _, unit_values in raw
+                                   for v in _split(unit_values[i]))
+                      for i, f in enumerate(self.fields)}
+            self._update(relid, values, fingerprint)
+            changed.append(relid)
+        for relid in set(self._by_relid) - seen:
+            self._remove(relid)
+            changed.append(relid)
+        return sorted(changed)
+
+    def _dump(self):
+        return {relid: [self._fingerprints[relid],
+                        {f: sorted(v) for f, v in values.items()}]
+                for relid, values in self._by_relid.items()}
+
+    @classmethod
+    def _load(cls, state):
+        requests = cls()
+        for relid, (fingerprint, values) in (state or {}).items():
+            requests._update(relid, {f: frozenset(values.get(f, ())) for f in cls.fields},
+                             fingerprint)
+        return requests
+
+
+def _split(s):
+    return [v.strip() for v in s.split(',') if v.strip()]
+
+
 class PostgreSQLServer(reactive.Endpoint):
     """
     PostgreSQL partial server side interface.
     """
+    _client_requests = None
+
     @when('endpoint.{endpoint_name}.joined')
     @when_not('{endpoint_name}.connected')
     def joined(self):
@@ -31,3 +144,137 @@ class PostgreSQLServer(reactive.Endpoint):
     @when_not('endpoint.{endpoint_name}.joined')
     def departed(self):
         reactive.clear_flag(self.expand_name('{endpoint_name}.connected'))
+
+    @property
+    def client_requests(self):
+        """:class:`ClientRequests` index of all client relations.
+
+        For example, to find the clients needing a database::
+
+            for relid in pgsql.client_requests.relids('database', 'mydb'):
+                ...
+        """
+        if self._client_requests is None:
+            kv = unitdata.kv()
+            key = self.expand_name('endpoint.{endpoint_name}.client-requests')
+            requests = ClientRequests._load(kv.get(key))
+            if requests.refresh(self.relations):
+                kv.set(key, requests._dump())
+            self._client_requests = requests
+        return self._client_requests
+
+    def _set_raw_value(self, key, value, relid=None):
+        # Clients expect raw relation data, as the PostgreSQL charm
+        # predates charms.reactive JSON encoding.
+        for relation in self.relations:
+            if relid is None or relid == relation.relation_id:
+                relation.to_publish_raw[key] = value
+
+    def set_standby_status(self, status, relid=None):
+        """Publish replication lag and health of the hot standbys.
+
+        Clients use this to avoid stale or broken replicas without
+        connecting to each of them.
+
+        :param status: dict mapping each standby connection string, as
+                       published in `standbys`, to a dict of metadata.
+                       `lag` is the replication lag in seconds and
+                       `healthy` a boolean. Other JSON serializable
+                       items are passed through to clients.
+
+        :param relid: relation id to publish the status to. If unset,
+                      it is published to all client relations.
+        """
+        self._set_raw_value('standby-status',
+                            json.dumps(status, sort_keys=True), relid)
+
+    def set_locality(self, locality, relid=None):
+        """Publish where the hot standbys are.
+
+        Clients use this to prefer standbys in their own availability
+        zone or region, and so avoid cross zone latency and traffic.
+
+        :param locality: dict mapping each standby connection string, as
+                         published in `standbys`, to a dict with `zone`
+                         and `region` items. Including the master lets
+                         clients find the region of its zone.
+
+        :param relid: relation id to publish the locality to. If unset,
+                      it is published to all client relations.
+        """
+        self._set_raw_value('locality',
+                            json.dumps(locality, sort_keys=True), relid)
+
+    def set_tls_material(self, ca=None, cert=None, key=None, sslmode=None,
+                         relid=None):
+        """Publish TLS material for clients to connect with.
+
+        Clients store the PEM encoded content in files and add the
+        sslrootcert, sslcert and sslkey paths to their connection
+        strings. If a CA certificate is provided and sslmode is not,
+        clients use verify-ca.
+
+        :param relid: relation id to publish the material to. If unset,
+                      it is published to all client relations.
+        """
+        for k, v in [('ssl-ca', ca), ('ssl-cert', cert), ('ssl-key', key),
+                     ('sslmode', sslmode)]:
+            self._set_raw_value(k, v or '', relid)
+
+    def set_topology(self, master, standbys=(), version=None, relid=None,
+                     legacy=True, leader_only=False, member=None):
+        """Publish the master and standby connection strings.
+
+        They are published as a single compact JSON payload in the
+        topology key, along with its SHA-256 hash in topology-hash.
+        Clients that have already seen a payload with that hash skip
+        parsing it.
+
+        By default every unit publishes the topology, so relation data
+        grows with the square of the number of units. With leader_only,
+        call this on every unit and only the leader publishes it. The
+        other units remove any topology they published, and publish
+        their own connection string in the member key. Clients wait
+        until every member has authorized them, as they do for units
+        publishing the topology.
+
+        Older clients only wait for units publishing master or
+        standbys. So with legacy, the other units still publish the
+        master, which is a single connection string, and the version.
+        Only the leader publishes the standbys, unless there is no
+        master, when they are published by every unit as before.
+
+        :param master: libpq connection string to the master, or None.
+        :param standbys: libpq connection strings to the hot standbys.
+        :param version: PostgreSQL major version, such as '10'.
+        :param relid: relation id to publish to. If unset, it is
+                      published to all client relations.
+        :param legacy: Also publish the master, standbys and version
+                       keys for older clients.
+        :param leader_only: Only publish the topology from the leader.
+        :param member: libpq connection string to this unit, published
+                       with leader_only.
+        """
+        standbys = sorted(str(s) for s in standbys)
+        if leader_only:
+            self._set_raw_value('member', member and str(member) or '', relid)
+            if not hookenv.is_leader():
+                self._set_raw_value('topology', '', relid)
+                self._set_raw_value('topology-hash', '', relid)
+                if legacy:
+                    self._set_raw_value('master', master and str(master) or '', relid)
+                    self._set_raw_value('standbys', '' if master else '\n'.join(standbys), relid)
+                    self._set_raw_value('version', version or '', relid)
+                return
+        payload = json.dumps(dict(protocol=TOPOLOGY_PROTOCOL,
+                                  master=master and str(master),
+                                  standbys=standbys,
+                                  version=version),
+                             sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha256(payload.encode('UTF-8')).hexdigest()
+        self._set_raw_value('topology', payload, relid)
+        self._set_raw_value('topology-hash', digest, relid)
+        if legacy:
+            self._set_raw_value('master', master and str(master) or '', relid)
+            self._set_raw_value('standbys', '\n'.join(standbys), relid)
+            self._set_raw_value('version', version or '', relid)
@@ -16,5 +16,5 @@ if __name__ == '__main__':
           author='Stuart Bishop',
           author_email='stuart.bishop@canonical.com',
           license='GPL3',
-          py_modules=['requires'],
+          py_modules=['requires', 'provides', 'topology'],
           install_requires=reqs)
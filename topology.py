@@ -0,0 +1,476 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Watch the PostgreSQL topology published by a charm, from a running
+application.
+
+The charm writes the file using PostgreSQLClient.publish_topology().
+This module only depends on the standard library, so the charm can
+install it alongside the application for the application to import:
+
+    import topology
+
+    pools = {}
+
+    def swap_pools(topo):
+        global pools
+        old, pools = pools, {relid: make_pool(svc.master)
+                             for relid, svc in topo.services.items()}
+        for pool in old.values():
+            pool.close()  # After in-flight requests complete
+
+    watcher = topology.TopologyWatcher('/srv/app/pgsql.json', swap_pools)
+    watcher.start()
+
+Pre-fork application servers with many workers can instead have the
+charm publish a memory mapped table with
+PostgreSQLClient.publish_topology_table(), which workers read without
+system calls or parsing:
+
+    table = topology.TopologyTable('/srv/app/pgsql.table')
+
+    def get_master():
+        if table.generation != cached_generation:
+            ...  # Reread using table.read()
+
+Connection strings are plain libpq key=value strings.
+
+asyncio applications can keep a connection pool per master and standby
+with AsyncPoolManager, which opens pools for new connection strings and
+drains those no longer published:
+
+    from psycopg_pool import AsyncConnectionPool
+
+    async def open_pool(conn_str):
+        pool = AsyncConnectionPool(conn_str, open=False)
+        await pool.open()
+        return pool
+
+    pools = topology.AsyncPoolManager(open_pool)
+    asyncio.ensure_future(pools.watch('/srv/app/pgsql.json'))
+
+    async with pools.standby().connection() as conn:
+        ...
+'''
+import asyncio
+from collections import namedtuple
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+__all__ = ['AsyncPoolManager', 'Service', 'Topology', 'TopologyTable',
+           'TopologyWatcher', 'load']
+
+log = logging.getLogger(__name__)
+
+# Must match TOPOLOGY_FORMAT in requires.py
+FORMAT = 1
+
+# Must match the TOPOLOGY_TABLE layout in requires.py
+TABLE_MAGIC = b'PGSQLTOP'
+TABLE_LAYOUT = 1
+TABLE_RETIRED = 0x1
+TABLE_MASTER = 1
+TABLE_STANDBY = 2
+_table_header = struct.Struct('<8sQIIIII28x')
+_table_entry = struct.Struct('<BxHI64s')
+_table_generation = struct.Struct('<Q')
+_table_generation_offset = 8
+_table_flags = struct.Struct('<I')
+_table_flags_offset = 20
+
+
+Service = namedtuple('Service', ['master', 'standbys', 'version'])
+
+
+class Topology(namedtuple('Topology', ['generation', 'services'])):
+    """A snapshot of the published topology.
+
+    generation increases with each change made by the charm. services
+    maps relation id to :class:`Service`.
+    """
+    __slots__ = ()
+
+    @property
+    def master(self):
+        """The first master connection string found, or None."""
+        for svc in self.services.values():
+            if svc.master:
+                return svc.master
+        return None
+
+    @property
+    def standbys(self):
+        """Set of standby connection strings across all services."""
+        return set(s for svc in self.services.values() for s in svc.standbys)
+
+
+def load(path):
+    """Load the :class:`Topology` published at path.
+
+    :raises ValueError: if the file is not in a supported format.
+    """
+    with open(path, 'r') as f:
+        d = json.load(f)
+    if not isinstance(d, dict) or d.get('format') != FORMAT:
+        raise ValueError('Unsupported topology format in {}'.format(path))
+    services = {relid: Service(r.get('master'), tuple(r.get('standbys') or ()),
+                               r.get('version'))
+                for relid, r in d.get('relations', {}).items()}
+    return Topology(d.get('generation', 0), services)
+
+
+class TopologyWatcher(object):
+    """Poll the published topology and report changes.
+
+    The charm replaces the file atomically, so a change of inode or
+    modification time is detected with a single stat() and the file is
+    only reparsed when it has changed.
+
+    :param path: The file written by the charm.
+    :param callback: Called with the new :class:`Topology` on each change,
+                     including the initial load. If it raises, the change
+                     is reported again on the next poll.
+    :param interval: Seconds between polls when run in a thread. Errors
+                     in the thread are logged and polling continues.
+    """
+    def __init__(self, path, callback=None, interval=1.0):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.current = None
+        self._stat = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """Poll the file once.
+
+        :returns: True if the topology changed.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._stat:
+            return False
+        try:
+            topo = load(self.path)
+        except ValueError:
+            return False  # Invalid or unsupported, keep the last good one.
+        if self.current is not None and topo.generation == self.current.generation:
+            self._stat = key
+            return False
+        if self.callback is not None:
+            self.callback(topo)
+        # Only recorded once handled, so a failure is retried. A single
+        # reference assignment, so other threads see either the old or
+        # the new topology and never a mix.
+        self._stat, self.current = key, topo
+        return True
+
+    def start(self):
+        """Poll in a daemon thread until :meth:`stop` is called."""
+        self.check()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='pgsql-topology-watcher')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                log.exception('Failed to update topology from %s', self.path)
+
+
+class TopologyTable(object):
+    """Reader of the memory mapped topology table.
+
+    The file is mapped once, and reads are then memory accesses. Check
+    :attr:`generation` to cheaply detect changes, and :meth:`read` to
+    get the current :class:`Topology`.
+
+    :raises ValueError: if the file is not a supported table.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+        self._map()
+
+    def _map(self):
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < _table_header.size:
+            mm.close()
+            raise ValueError('Truncated topology table {}'.format(self.path))
+        magic, _, layout, _, slots, slot_size, _ = _table_header.unpack_from(mm)
+        if magic != TABLE_MAGIC or layout != TABLE_LAYOUT:
+            mm.close()
+            raise ValueError('Unsupported topology table {}'.format(self.path))
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mm
+        self._slots = slots
+        self._entry_size = _table_entry.size + slot_size
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    @property
+    def retired(self):
+        """True if the charm has replaced the file with a new one."""
+        return bool(_table_flags.unpack_from(self._mm, _table_flags_offset)[0] & TABLE_RETIRED)
+
+    @property
+    def generation(self):
+        """Change counter. Odd while the charm is updating the table.
+
+        This is reset when the charm replaces the file with a new
+        layout, which :meth:`read` handles by remapping.
+        """
+        return _table_generation.unpack_from(self._mm, _table_generation_offset)[0]
+
+    def read(self, timeout=1.0):
+        """:returns: The current :class:`Topology`.
+
+        :raises TimeoutError: if an update does not complete in time,
+                              such as when the charm died mid update.
+        """
+        if self.retired:
+            self._map()
+        deadline = None
+        while True:
+            before = self.generation
+            if before % 2 == 0:
+                services = self._read_services()
+                if self.generation == before:
+                    return Topology(before, services)
+            # An update is in progress. Spin briefly, then back off.
+            if deadline is None:
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError('Topology table {} update incomplete'.format(self.path))
+            else:
+                time.sleep(0.0001)
+
+    def _read_services(self):
+        mm = self._mm
+        count = _table_header.unpack_from(mm)[6]
+        masters = {}
+        standbys = {}
+        offset = _table_header.size
+        for _ in range(min(count, self._slots)):
+            role, relid_len, conn_len, relid = _table_entry.unpack_from(mm, offset)
+            start = offset + _table_entry.size
+            relid = relid[:relid_len].decode('UTF-8', 'replace')
+            conn_str = mm[start:start + conn_len].decode('UTF-8', 'replace')
+            if role == TABLE_MASTER:
+                masters[relid] = conn_str
+            elif role == TABLE_STANDBY:
+                standbys.setdefault(relid, []).append(conn_str)
+            offset += self._entry_size
+        return {relid: Service(masters.get(relid), tuple(standbys.get(relid, ())), None)
+                for relid in set(masters) | set(standbys)}
+
+
+class AsyncPoolManager(object):
+    """asyncio connection pools for the published topology.
+
+    Holds one pool per master and standby connection string. When the
+    topology changes, pools are opened for new connection strings
+    before they are routed to, and pools for connection strings no
+    longer published are closed in the background, letting in-flight
+    work finish. Routing is a dictionary lookup, so never blocks the
+    event loop. Pools that fail to open are retried with exponential
+    backoff by later updates and by :meth:`watch`.
+
+    :param open_pool: Coroutine function called with a connection
+                      string, returning an open pool.
+    :param close_pool: Coroutine function called with a pool to close
+                       it gracefully. Defaults to awaiting pool.close().
+    :param drain_timeout: Seconds to wait for a pool to close before
+                          abandoning it.
+    :param retry_interval: Seconds to wait before retrying a pool that
+                           failed to open, doubling with each failure.
+    :param retry_max: Maximum seconds between retries.
+    :param clock: Function returning the current time in seconds, used
+                  for retries. Defaults to the event loop's clock.
+    """
+    def __init__(self, open_pool, close_pool=None, drain_timeout=30.0,
+                 retry_interval=1.0, retry_max=60.0, clock=None):
+        self._open_pool = open_pool
+        self._close_pool = close_pool or _close_pool
+        self.drain_timeout = drain_timeout
+        self.retry_interval = retry_interval
+        self.retry_max = retry_max
+        self._clock = clock
+        self.current = None
+        self._pools = {}
+        self._routes = {}
+        self._counter = itertools.count()
+        self._draining = set()
+        self._failed = {}  # conn_str -> (failures, time of next attempt)
+        self._lock = None
+
+    @property
+    def pools(self):
+        """dict of connection string to open pool."""
+        return dict(self._pools)
+
+    async def update(self, topo):
+        """Open and route to pools for a new :class:`Topology`, and drain
+        pools no longer needed.
+
+        :returns: list of connection strings whose pools failed to open,
+                  or are waiting to be retried. They are not routed to.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            wanted = set()
+            for svc in topo.services.values():
+                if svc.master:
+                    wanted.add(svc.master)
+                wanted.update(svc.standbys)
+            now = self._now()
+            self._failed = {c: f for c, f in self._failed.items() if c in wanted}
+            new = sorted(c for c in wanted - set(self._pools)
+                         if c not in self._failed or self._failed[c][1] <= now)
+            results = await asyncio.gather(*(self._open_pool(c) for c in new),
+                                           return_exceptions=True)
+            pools = {c: p for c, p in self._pools.items() if c in wanted}
+            for conn_str, result in zip(new, results):
+                if isinstance(result, BaseException):
+                    failures = self._failed.get(conn_str, (0, None))[0] + 1
+                    delay = min(self.retry_interval * 2 ** (failures - 1), self.retry_max)
+                    self._failed[conn_str] = (failures, now + delay)
+                else:
+                    self._failed.pop(conn_str, None)
+                    pools[conn_str] = result
+            routes = {}
+            for relid, svc in topo.services.items():
+                routes[relid] = (svc.master if svc.master in pools else None,
+                                 tuple(s for s in sorted(svc.standbys) if s in pools))
+            old = [p for c, p in self._pools.items() if c not in wanted]
+            # Swap with single assignments, so routing sees either the
+            # old or the new pools.
+            self._pools, self._routes, self.current = pools, routes, topo
+            for pool in old:
+                task = asyncio.ensure_future(self._drain(pool))
+                self._draining.add(task)
+                task.add_done_callback(self._draining.discard)
+            return sorted(self._failed)
+
+    def _now(self):
+        if self._clock is None:
+            return asyncio.get_running_loop().time()
+        return self._clock()
+
+    def _retry_due(self):
+        now = self._now()
+        return any(t <= now for _, t in self._failed.values())
+
+    async def _drain(self, pool):
+        try:
+            await asyncio.wait_for(self._close_pool(pool), self.drain_timeout)
+        except Exception:
+            pass  # Timed out or failed. Nothing more can be done.
+
+    def master(self, relid=None):
+        """The pool for the master.
+
+        :param relid: The relation id of the service. If unset, the
+                      first service with a master.
+        :raises LookupError: if there is no master pool.
+        """
+        for rid, (master, _) in self._select(relid):
+            if master is not None:
+                return self._pools[master]
+        raise LookupError('No master for {}'.format(relid or 'any service'))
+
+    def standby(self, relid=None, fallback=True):
+        """A pool for a hot standby, round robin across the standbys.
+
+        :param relid: The relation id of the service. If unset, the
+                      standbys of all services.
+        :param fallback: Return the master pool if there are no
+                         standbys.
+        :raises LookupError: if there is no suitable pool.
+        """
+        standbys = [s for _, (_, stbys) in self._select(relid) for s in stbys]
+        if standbys:
+            return self._pools[standbys[next(self._counter) % len(standbys)]]
+        if fallback:
+            return self.master(relid)
+        raise LookupError('No standbys for {}'.format(relid or 'any service'))
+
+    def _select(self, relid):
+        routes = self._routes
+        if relid is None:
+            return sorted(routes.items())
+        if relid not in routes:
+            raise LookupError(relid)
+        return [(relid, routes[relid])]
+
+    async def watch(self, path, interval=1.0):
+        """Update the pools whenever the topology file at path changes.
+
+        Runs until cancelled. The file is checked in the default
+        executor, so the event loop is never blocked on file access.
+        Pools that failed to open are retried when due, and other
+        errors are logged.
+        """
+        loop = asyncio.get_running_loop()
+        watcher = TopologyWatcher(path)
+        while True:
+            try:
+                if await loop.run_in_executor(None, watcher.check):
+                    await self.update(watcher.current)
+                elif self.current is not None and self._retry_due():
+                    await self.update(self.current)
+            except Exception:
+                log.exception('Failed to update pools from %s', path)
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        """Close all pools, including those still draining."""
+        pools, self._pools, self._routes = list(self._pools.values()), {}, {}
+        for pool in pools:
+            task = asyncio.ensure_future(self._drain(pool))
+            self._draining.add(task)
+            task.add_done_callback(self._draining.discard)
+        if self._draining:
+            await asyncio.gather(*self._draining)
+
+
+async def _close_pool(pool):
+    await pool.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark ConnectionString parsing and quoting against libpq.
+
+Reports the throughput of each parser over a generated corpus, and
+where ConnectionString parses differently to libpq. libpq is used via
+psycopg2 if it is installed, with the Python port of its parser in
+test_conninfo.py standing in otherwise.
+
+    python3 unit_tests/bench_conninfo.py [--size N] [--seed N] [--simple]
+'''
+
+import argparse
+import os.path
+import sys
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+from test_conninfo import (
+    ConnInfoError,
+    components,
+    corpus,
+    libpq_parse,
+    parse_dsn,
+    reference_parse,
+)
+
+from requires import ConnectionString
+
+
+def throughput(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        try:
+            fn(item)
+        except ConnInfoError:
+            pass
+    elapsed = time.perf_counter() - start
+    return len(items) / elapsed if elapsed else float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--simple', action='store_true',
+                        help='only values that need no quoting or escaping')
+    parser.add_argument('--examples', type=int, default=5,
+                        help='number of divergent inputs to show')
+    args = parser.parse_args()
+
+    items = corpus(args.seed, args.size, args.simple)
+    conninfos = [conninfo for _, conninfo in items]
+    kws = [kw for kw, _ in items]
+
+    oracle_name, oracle = 'reference', reference_parse
+    if parse_dsn is not None:
+        oracle_name, oracle = 'libpq', libpq_parse
+
+    print('corpus: {} strings, seed {}{}'.format(
+        args.size, args.seed, ', simple' if args.simple else ''))
+    print('throughput (strings/second):')
+    print('  ConnectionString parse  {:>12,.0f}'.format(
+        throughput(ConnectionString, conninfos)))
+    print('  ConnectionString render {:>12,.0f}'.format(
+        throughput(lambda kw: ConnectionString(**kw), kws)))
+    print('  reference parse         {:>12,.0f}'.format(
+        throughput(reference_parse, conninfos)))
+    if parse_dsn is not None:
+        print('  libpq parse             {:>12,.0f}'.format(
+            throughput(libpq_parse, conninfos)))
+
+    parse_divergent = []
+    quote_divergent = []
+    for kw, conninfo in items:
+        expected = oracle(conninfo)
+        if components(ConnectionString(conninfo)) != expected:
+            parse_divergent.append(conninfo)
+        if oracle(ConnectionString(**kw)) != kw:
+            quote_divergent.append(kw)
+
+    print('divergences from {}:'.format(oracle_name))
+    print('  parse {:>6} ({:.2%})'.format(
+        len(parse_divergent), len(parse_divergent) / len(items)))
+    for conninfo in parse_divergent[:args.examples]:
+        print('    {!r}'.format(conninfo))
+    print('  quote {:>6} ({:.2%})'.format(
+        len(quote_divergent), len(quote_divergent) / len(items)))
+    for kw in quote_divergent[:args.examples]:
+        print('    {!r}'.format(kw))
+
+    return 1 if quote_divergent else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
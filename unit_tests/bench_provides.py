@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark PostgreSQLServer against growing numbers of client relations.
+
+Each synthetic deployment of N client relations, with several units
+each, is driven through two simulated hooks: the first sees every
+relation as new, and the second, a steady state hook, sees one changed
+relation. Each hook runs the endpoint handlers, indexes client requests
+and publishes the topology and standby status.
+
+Reports per-hook latency, relation data written and peak memory, and
+fails if the cost grows more than linearly with the number of relations
+between any two adjacent sizes, or if a saved baseline is exceeded.
+Each hook is timed with garbage collection disabled and the fastest
+of several repeats reported, with the relations built outside the
+timer. Peak memory is measured in a separate run, so tracing does not
+slow the timed hooks.
+
+    python3 unit_tests/bench_provides.py [--sizes 1,10,100,1000,2000]
+        [--units 3] [--repeat 5] [--save FILE] [--baseline FILE]
+        [--tolerance 1.5]
+'''
+
+import argparse
+import gc
+import json
+import math
+import os.path
+import sys
+import time
+import tracemalloc
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from charmhelpers.core import unitdata
+from charms.reactive.endpoints import KeyList
+
+from fake_relations import make_relation
+import provides
+
+
+# Allowed exponent of cost growth between adjacent deployment sizes,
+# where cost grows with size ** exponent. Linear scaling is 1, and
+# quadratic 2. Fixed overhead dominates the smallest sizes and lowers
+# the exponent there, which is why only adjacent sizes are compared.
+MAX_SCALING_EXPONENT = 1.5
+
+
+def deployment(size, units, changed=None):
+    """Client relation data for a synthetic deployment."""
+    clients = {}
+    for r in range(size):
+        relid = 'db:{}'.format(r)
+        app = 'app{}'.format(r)
+        clients[relid] = {
+            '{}/{}'.format(app, u): {
+                'database': app if relid != changed else app + '-new',
+                'roles': 'reader,{}'.format(app),
+                'extensions': 'citext',
+                'egress-subnets': '10.{}.{}.{}/32'.format(r // 256, r % 256, u)}
+            for u in range(units)}
+    return clients
+
+
+def relations(clients):
+    """Relations holding the client relation data."""
+    return KeyList([make_relation(relid, units)
+                    for relid, units in sorted(clients.items())],
+                   key_attr='relation_id')
+
+
+def hook(relations, standbys=3):
+    """Simulate a hook on the server, returning the endpoint."""
+    server = provides.PostgreSQLServer('db')
+    server._relations = relations
+    server.joined()
+    requests = server.client_requests
+    for relid in requests:
+        requests.values('database', relid)
+    standby_strs = ['host=10.0.0.{} port=5432'.format(i + 2) for i in range(standbys)]
+    server.set_topology('host=10.0.0.1 port=5432', standby_strs, '10')
+    server.set_standby_status({s: dict(lag=0.5, healthy=True) for s in standby_strs})
+    return server
+
+
+def written(server):
+    """Bytes of relation data published by the endpoint."""
+    return sum(len(k) + len(v or '')
+               for relation in server.relations
+               for k, v in relation.to_publish_raw.items())
+
+
+def simulate(size, units, traced=False):
+    """Run the initial and steady state hooks on a fresh deployment.
+
+    Yields (hook name, seconds, server, peak traced bytes or None).
+    """
+    kv = unitdata.Storage(':memory:')
+    with patch('charmhelpers.core.unitdata.kv', return_value=kv):
+        for name, changed in (('initial', None), ('steady', 'db:0')):
+            rels = relations(deployment(size, units, changed))
+            gc.collect()
+            gc.disable()
+            if traced:
+                tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                server = hook(rels)
+                elapsed = time.perf_counter() - start
+                peak = None
+                if traced:
+                    _, peak = tracemalloc.get_traced_memory()
+            finally:
+                if traced:
+                    tracemalloc.stop()
+                gc.enable()
+            yield name, elapsed, server, peak
+
+
+def measure(size, units):
+    """Metrics for each hook of a single run."""
+    results = {}
+    for name, seconds, server, _ in simulate(size, units):
+        results[name] = dict(seconds=seconds, bytes=written(server))
+    return results
+
+
+def check_scaling(results):
+    """Failures where cost grows more than linearly between adjacent sizes."""
+    failures = []
+    sizes = sorted(results)
+    for small, large in zip(sizes, sizes[1:]):
+        for hook_name in ('initial', 'steady'):
+            for metric in ('seconds', 'bytes'):
+                cost_small = results[small][hook_name][metric]
+                cost_large = results[large][hook_name][metric]
+                if not cost_small or not cost_large:
+                    continue
+                exponent = math.log(cost_large / cost_small) / math.log(large / small)
+                if exponent > MAX_SCALING_EXPONENT:
+                    failures.append('{} {} grew as size ** {:.2f} from {} to {} relations'.format(
+                        hook_name, metric, exponent, small, large))
+    return failures
+
+
+def check_baseline(results, baseline, tolerance):
+    """Failures where results exceed a saved baseline."""
+    failures = []
+    for size, hooks in results.items():
+        for hook_name, metrics in hooks.items():
+            for metric, value in metrics.items():
+                try:
+                    base = baseline[str(size)][hook_name][metric]
+                except KeyError:
+                    continue
+                if base and value > base * tolerance:
+                    failures.append('{} relations {} {} {} exceeds baseline {}'.format(
+                        size, hook_name, metric, value, base))
+    return failures
+
+
+def run(sizes, units, repeat=5):
+    """Metrics by size and hook, with seconds the fastest of repeat runs.
+
+    Repeats cycle through the sizes, so a slow period on the machine
+    affects all sizes rather than skewing their comparison.
+    """
+    results = {}
+    for _ in range(repeat):
+        for size in sizes:
+            for name, metrics in measure(size, units).items():
+                r = results.setdefault(size, {}).setdefault(name, metrics)
+                r['seconds'] = min(r['seconds'], metrics['seconds'])
+    for size in sizes:
+        for name, _, _, peak in simulate(size, units, traced=True):
+            results[size][name]['peak'] = peak
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1,10,100,1000,2000')
+    parser.add_argument('--units', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='run each hook N times and report the fastest')
+    parser.add_argument('--save', help='write results as a baseline')
+    parser.add_argument('--baseline', help='fail if results exceed this baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed factor over the baseline')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run(sizes, args.units, args.repeat)
+
+    print('{:>8} {:>8} {:>12} {:>12} {:>12}'.format(
+        'clients', 'hook', 'ms', 'bytes', 'peak KiB'))
+    for size in sizes:
+        for hook_name in ('initial', 'steady'):
+            r = results[size][hook_name]
+            print('{:>8} {:>8} {:>12.2f} {:>12} {:>12.0f}'.format(
+                size, hook_name, r['seconds'] * 1000, r['bytes'], r['peak'] / 1024))
+
+    failures = check_scaling(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures.extend(check_baseline(results, json.load(f), args.tolerance))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for failure in failures:
+        print('REGRESSION: {}'.format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
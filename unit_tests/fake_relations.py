@@ -0,0 +1,37 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Relations built from plain data, without a Juju model.
+
+Shared by the tests, the benchmarks and the hook replay tool.
+'''
+
+from charms.reactive.endpoints import (
+    CombinedUnitsView,
+    JSONUnitDataView,
+    RelatedUnit,
+    Relation,
+)
+
+
+def make_relation(relid, units, local=None):
+    """Construct a Relation with the given remote and local data."""
+    relation = Relation(relid)
+    relation._units = CombinedUnitsView([
+        RelatedUnit(relation, name, JSONUnitDataView(dict(data)))
+        for name, data in units.items()])
+    relation._data = JSONUnitDataView(dict(local or {}), writeable=True)
+    return relation
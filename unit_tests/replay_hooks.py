@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Replay hooks recorded by PostgreSQLClient.record_hooks() offline.
+
+Each recorded hook is run through PostgreSQLClient in order, starting
+from the flags recorded at the start of the hook and with the recorded
+relation data. The endpoint's automatic flags are updated and its
+handlers dispatched as charms.reactive would, and the flags it sets or
+clears compared with those recorded. Charm handlers are not replayed.
+
+Reports the time taken by each hook, and exits non-zero if any hook
+produced different flags.
+
+    python3 unit_tests/replay_hooks.py TRACE [--repeat N] [--quiet]
+'''
+
+import argparse
+import ast
+import inspect
+import json
+import os.path
+import sys
+import textwrap
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from charmhelpers.core import unitdata
+from charms.reactive import clear_flag, is_flag_set, set_flag
+from charms.reactive.endpoints import KeyList
+
+from fake_relations import make_relation
+import requires
+
+
+def handlers(endpoint_class):
+    """List of (method name, when flags, when_not flags) of the handlers
+    declared by endpoint_class, in the order they are declared.
+
+    charms.reactive only registers handlers for endpoints named in the
+    charm's metadata, so they are read from the decorators in the source.
+    """
+    tree = ast.parse(textwrap.dedent(inspect.getsource(endpoint_class)))
+    result = []
+    for node in tree.body[0].body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        when, when_not = [], []
+        for decorator in node.decorator_list:
+            if not (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name)):
+                continue
+            flags = [ast.literal_eval(arg) for arg in decorator.args]
+            if decorator.func.id in ('when', 'when_all'):
+                when.extend(flags)
+            elif decorator.func.id in ('when_not', 'when_none'):
+                when_not.extend(flags)
+            elif decorator.func.id.startswith('when'):
+                raise ValueError('Unsupported condition {} on {}'.format(
+                    decorator.func.id, node.name))
+        if when or when_not:
+            result.append((node.name, when, when_not))
+    return result
+
+
+HANDLERS = handlers(requires.PostgreSQLClient)
+
+
+def load(path):
+    """List of hook records from a trace."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def dispatch(endpoint):
+    """Invoke the endpoint's handlers until none are ready to run."""
+    done = set()
+    while True:
+        for method, when, when_not in HANDLERS:
+            if method in done:
+                continue
+            ready = all(is_flag_set(endpoint.expand_name(f)) for f in when)
+            if ready and not any(is_flag_set(endpoint.expand_name(f)) for f in when_not):
+                done.add(method)
+                getattr(endpoint, method)()
+                break
+        else:
+            return
+
+
+def replay_hook(record):
+    """Replay a hook record, with unitdata.kv() already patched.
+
+    :returns: (seconds, flag_changes) where flag_changes maps the flags
+              the endpoint set to True, and those it cleared to False.
+    """
+    endpoint = requires.PostgreSQLClient(record['endpoint'])
+    endpoint._relations = KeyList(
+        [make_relation(relid, rel['units'], rel['local'])
+         for relid, rel in record['relations'].items()],
+        key_attr='relation_id')
+    for flag in endpoint._endpoint_flags():
+        clear_flag(flag)
+    for flag in record['flags_before']:
+        set_flag(flag)
+    endpoint._flag_changes = {}
+
+    env = dict(hook_name=record['hook'], relation_id=record['relid'],
+               remote_unit=record['remote_unit'], local_unit=record['local_unit'])
+    patchers = [patch('charmhelpers.core.hookenv.{}'.format(name), return_value=value)
+                for name, value in env.items()]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        start = time.perf_counter()
+        endpoint._manage_flags()
+        dispatch(endpoint)
+        elapsed = time.perf_counter() - start
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+    return elapsed, endpoint._flag_changes
+
+
+def flag_differences(recorded, replayed):
+    """Sorted list of (flag, recorded, replayed) that differ.
+
+    Each is True if the flag was set, False if cleared and None if
+    left alone.
+    """
+    return sorted((flag, recorded.get(flag), replayed.get(flag))
+                  for flag in set(recorded) | set(replayed)
+                  if recorded.get(flag) != replayed.get(flag))
+
+
+def replay(records, repeat=1):
+    """Replay hook records in order.
+
+    :returns: list of (record, seconds, differences), with seconds the
+              fastest of repeat runs.
+    """
+    results = []
+    kv = unitdata.Storage(':memory:')
+    with patch('charmhelpers.core.unitdata.kv', return_value=kv):
+        for record in records:
+            timings = []
+            for i in range(repeat):
+                seconds, changes = replay_hook(record)
+                timings.append(seconds)
+                # Repeats start from the same state, and only the
+                # last run is kept for the next hook.
+                kv.flush(save=i == repeat - 1)
+            results.append((record, min(timings),
+                            flag_differences(record['flag_changes'] or {}, changes)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trace', help='JSONL trace written by record_hooks()')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run each hook N times and report the fastest')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only report hooks with differences')
+    args = parser.parse_args()
+
+    results = replay(load(args.trace), args.repeat)
+    failed = 0
+    for n, (record, seconds, differences) in enumerate(results):
+        if differences:
+            failed += 1
+        elif args.quiet:
+            continue
+        print('{:>5} {:<40} {:>5} relations {:>9.2f} ms {}'.format(
+            n, record['hook'], len(record['relations']), seconds * 1000,
+            'DIFFERS' if differences else 'ok'))
+        for flag, recorded, replayed in differences:
+            print('        {}: recorded {}, replayed {}'.format(
+                flag, _describe(recorded), _describe(replayed)))
+    total = sum(seconds for _, seconds, _ in results)
+    print('{} hooks, {:.2f} ms total, {} with differences'.format(
+        len(results), total * 1000, failed))
+    return 1 if failed else 0
+
+
+def _describe(change):
+    return {True: 'set', False: 'cleared', None: 'unchanged'}[change]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Differential tests of ConnectionString against libpq's conninfo parser.
+
+libpq is used via psycopg2 when it is installed. A Python port of
+libpq's conninfo_parse() is always used, so the tests run without it.
+See bench_conninfo.py for throughput and divergence reports.
+'''
+
+import os.path
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from requires import ConnectionString
+
+try:
+    from psycopg2.extensions import parse_dsn
+except ImportError:
+    parse_dsn = None
+
+
+# Options libpq accepts. It rejects unknown keys, so the corpus is
+# limited to these.
+LIBPQ_KEYS = ['application_name', 'client_encoding', 'connect_timeout',
+              'dbname', 'fallback_application_name', 'host', 'hostaddr',
+              'keepalives', 'keepalives_count', 'keepalives_idle',
+              'keepalives_interval', 'options', 'passfile', 'password',
+              'port', 'service', 'sslcert', 'sslcrl', 'sslkey', 'sslmode',
+              'sslrootcert', 'target_session_attrs', 'user']
+
+# isspace() in the C locale, as used by libpq.
+C_SPACE = ' \t\n\v\f\r'
+
+# Characters values are built from, weighted towards the awkward.
+ALPHABET = ['a', 'b', 'z', 'A', 'Z', '0', '9', '_', '-', '.', '/', ':',
+            '@', '=', '?', '&', '%', '[', ']',
+            '\\', "'", '"', ' ', '\t',
+            'é', 'ß', '中', '\U0001f418', '\xa0']
+
+IPV6_HOSTS = ['::1', '2001:db8::1234', 'fe80::1%eth0',
+              '2001:0db8:0000:0000:0000:ff00:0042:8329']
+
+
+class ConnInfoError(ValueError):
+    pass
+
+
+def reference_parse(conninfo):
+    """Python port of libpq's conninfo_parse() (fe-connect.c).
+
+    :returns: dict of options, later duplicates overriding.
+    :raises ConnInfoError: where libpq would fail to parse.
+    """
+    options = {}
+    i, n = 0, len(conninfo)
+    while i < n:
+        # Skip blanks before the parameter name
+        if conninfo[i] in C_SPACE:
+            i += 1
+            continue
+
+        # Get the parameter name
+        start = i
+        while i < n and conninfo[i] != '=' and conninfo[i] not in C_SPACE:
+            i += 1
+        pname = conninfo[start:i]
+        while i < n and conninfo[i] in C_SPACE:
+            i += 1
+
+        # Check that there is a following '='
+        if i >= n or conninfo[i] != '=':
+            raise ConnInfoError('missing "=" after "{}"'.format(pname))
+        i += 1
+
+        # Skip blanks after the '='
+        while i < n and conninfo[i] in C_SPACE:
+            i += 1
+
+        # Get the parameter value
+        pval = []
+        if i < n and conninfo[i] == "'":
+            i += 1
+            while True:
+                if i >= n:
+                    raise ConnInfoError('unterminated quoted string')
+                if conninfo[i] == '\\':
+                    i += 1
+                    if i < n:
+                        pval.append(conninfo[i])
+                        i += 1
+                    continue
+                if conninfo[i] == "'":
+                    i += 1
+                    break
+                pval.append(conninfo[i])
+                i += 1
+        else:
+            while i < n:
+                if conninfo[i] in C_SPACE:
+                    i += 1
+                    break
+                if conninfo[i] == '\\':
+                    i += 1
+                    if i < n:
+                        pval.append(conninfo[i])
+                        i += 1
+                else:
+                    pval.append(conninfo[i])
+                    i += 1
+        options[pname] = ''.join(pval)
+    return options
+
+
+def libpq_parse(conninfo):
+    """Parse conninfo with libpq itself, via psycopg2."""
+    try:
+        return parse_dsn(conninfo)
+    except Exception as x:
+        raise ConnInfoError(str(x))
+
+
+def random_value(rng, simple=False):
+    if simple:
+        return ''.join(rng.choice(ALPHABET[:19])
+                       for _ in range(rng.randint(1, 12)))
+    if rng.random() < 0.1:
+        return rng.choice(IPV6_HOSTS)
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 12)))
+
+
+def random_components(rng, simple=False):
+    """A random dict of libpq options to non-empty values."""
+    keys = rng.sample(LIBPQ_KEYS, rng.randint(1, 8))
+    return {k: random_value(rng, simple) for k in keys}
+
+
+def render(rng, kw):
+    """Render kw as a conninfo string, in a random valid style."""
+    parts = []
+    for k, v in kw.items():
+        quoted = rng.random() < 0.5 or not v or any(c in C_SPACE for c in v)
+        if quoted:
+            v = "'" + v.replace('\\', '\\\\').replace("'", "\\'") + "'"
+        else:
+            v = v.replace('\\', '\\\\').replace("'", "\\'")
+        eq = rng.choice(['=', ' = ', '=  ', '\t=\t'])
+        parts.append('{}{}{}'.format(k, eq, v))
+    return rng.choice([' ', '  ', '\t']).join(parts)
+
+
+def corpus(seed, size, simple=False):
+    """Deterministic list of (components, conninfo) pairs."""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(size):
+        kw = random_components(rng, simple)
+        result.append((kw, render(rng, kw)))
+    return result
+
+
+def components(conn_str):
+    return {k: str(v) for k, v in conn_str._components.items() if v}
+
+
+class TestReferenceParser(unittest.TestCase):
+    def test_examples(self):
+        self.assertEqual(reference_parse("host=a  port = 5432 dbname='my db'"),
+                         dict(host='a', port='5432', dbname='my db'))
+        self.assertEqual(reference_parse(r"user='it\'s' password=a\ b"),
+                         dict(user="it's", password='a b'))
+        self.assertEqual(reference_parse("dbname='x'user=y"),
+                         dict(dbname='x', user='y'))
+        with self.assertRaises(ConnInfoError):
+            reference_parse("dbname='x")
+        with self.assertRaises(ConnInfoError):
+            reference_parse("dbname x")
+
+    def test_corpus(self):
+        for kw, conninfo in corpus(1, 2000):
+            self.assertEqual(reference_parse(conninfo), kw, conninfo)
+
+    @unittest.skipIf(parse_dsn is None, 'psycopg2 is not installed')
+    def test_matches_libpq(self):
+        rng = random.Random(2)
+        for kw, conninfo in corpus(2, 2000):
+            # Also try some truncated and therefore often invalid strings.
+            for s in (conninfo, conninfo[:rng.randint(0, len(conninfo))]):
+                try:
+                    expected = libpq_parse(s)
+                except ConnInfoError:
+                    with self.assertRaises(ConnInfoError, msg=repr(s)):
+                        reference_parse(s)
+                else:
+                    self.assertEqual(reference_parse(s), expected, repr(s))
+
+
+class TestConnectionStringDifferential(unittest.TestCase):
+    def test_quoting(self):
+        # Strings rendered by ConnectionString parse back to the same
+        # components in libpq.
+        rng = random.Random(3)
+        for _ in range(2000):
+            kw = random_components(rng)
+            conn_str = ConnectionString(**kw)
+            self.assertEqual(reference_parse(conn_str), kw, repr(conn_str))
+            if parse_dsn is not None:
+                self.assertEqual(libpq_parse(conn_str), kw, repr(conn_str))
+
+    def test_parse_simple(self):
+        # Where values don't need quoting or escaping, ConnectionString
+        # parses the same as libpq.
+        for kw, conninfo in corpus(4, 2000, simple=True):
+            conn_str = ConnectionString(conninfo)
+            self.assertEqual(components(conn_str), kw, conninfo)
+
+    def test_roundtrip(self):
+        # Reparsing a rendered ConnectionString is lossless.
+        rng = random.Random(5)
+        for _ in range(2000):
+            kw = random_components(rng, simple=True)
+            conn_str = ConnectionString(**kw)
+            self.assertEqual(ConnectionString(conn_str), conn_str)
@@ -0,0 +1,195 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os.path
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from charmhelpers.core import unitdata
+from charms.reactive.endpoints import KeyList
+
+import bench_provides
+from fake_relations import make_relation
+import provides
+
+
+def make_server(*relations):
+    server = provides.PostgreSQLServer('db')
+    server._relations = KeyList(relations, key_attr='relation_id')
+    return server
+
+
+class TestPostgreSQLServer(unittest.TestCase):
+    def test_set_standby_status(self):
+        rel1 = make_relation('db:1', {'client/0': {}})
+        rel2 = make_relation('db:2', {'other/0': {}})
+        server = make_server(rel1, rel2)
+        status = {'host=10.0.0.2': dict(lag=1.5, healthy=True),
+                  'host=10.0.0.3': dict(lag=None, healthy=False)}
+        server.set_standby_status(status)
+        for rel in (rel1, rel2):
+            self.assertEqual(json.loads(rel.to_publish_raw['standby-status']),
+                             status)
+
+        server.set_standby_status({}, relid='db:2')
+        self.assertEqual(rel2.to_publish_raw['standby-status'], '{}')
+        self.assertNotEqual(rel1.to_publish_raw['standby-status'], '{}')
+
+    def test_set_locality(self):
+        rel = make_relation('db:1', {'client/0': {}})
+        locality = {'host=10.0.0.2': dict(zone='az1', region='r1')}
+        make_server(rel).set_locality(locality)
+        self.assertEqual(json.loads(rel.to_publish_raw['locality']), locality)
+
+    def test_set_tls_material(self):
+        rel = make_relation('db:1', {'client/0': {}})
+        server = make_server(rel)
+        server.set_tls_material(ca='CA PEM', sslmode='verify-full')
+        self.assertEqual(rel.to_publish_raw['ssl-ca'], 'CA PEM')
+        self.assertEqual(rel.to_publish_raw['sslmode'], 'verify-full')
+        self.assertEqual(rel.to_publish_raw['ssl-key'], '')
+
+    def test_set_topology(self):
+        rel = make_relation('db:1', {'client/0': {}})
+        server = make_server(rel)
+        server.set_topology('host=10.0.0.1', ['host=10.0.0.3', 'host=10.0.0.2'], '10')
+        data = rel.to_publish_raw
+        self.assertEqual(json.loads(data['topology']),
+                         dict(protocol=3, master='host=10.0.0.1',
+                              standbys=['host=10.0.0.2', 'host=10.0.0.3'],
+                              version='10'))
+        self.assertEqual(data['topology-hash'],
+                         hashlib.sha256(data['topology'].encode('UTF-8')).hexdigest())
+        self.assertEqual(data['master'], 'host=10.0.0.1')
+        self.assertEqual(data['standbys'], 'host=10.0.0.2\nhost=10.0.0.3')
+        self.assertEqual(data['version'], '10')
+
+    def test_set_topology_leader_only(self):
+        rel = make_relation('db:1', {'client/0': {}})
+        server = make_server(rel)
+        with patch('charmhelpers.core.hookenv.is_leader', return_value=True):
+            server.set_topology('host=10.0.0.1', ['host=10.0.0.2'], leader_only=True,
+                                member='host=10.0.0.1')
+        self.assertEqual(rel.to_publish_raw['member'], 'host=10.0.0.1')
+        self.assertEqual(rel.to_publish_raw['standbys'], 'host=10.0.0.2')
+        self.assertTrue(rel.to_publish_raw['topology'])
+
+        # Leadership lost, so the topology is withdrawn. The master is
+        # still published, so older clients wait for this unit.
+        with patch('charmhelpers.core.hookenv.is_leader', return_value=False):
+            server.set_topology('host=10.0.0.1', ['host=10.0.0.2'], '10', leader_only=True,
+                                member='host=10.0.0.1')
+        self.assertEqual(rel.to_publish_raw['member'], 'host=10.0.0.1')
+        for key in ('topology', 'topology-hash', 'standbys'):
+            self.assertEqual(rel.to_publish_raw[key], '')
+        self.assertEqual(rel.to_publish_raw['master'], 'host=10.0.0.1')
+        self.assertEqual(rel.to_publish_raw['version'], '10')
+
+        # Without a master, the standbys are published instead.
+        with patch('charmhelpers.core.hookenv.is_leader', return_value=False):
+            server.set_topology(None, ['host=10.0.0.2'], leader_only=True)
+        self.assertEqual(rel.to_publish_raw['master'], '')
+        self.assertEqual(rel.to_publish_raw['standbys'], 'host=10.0.0.2')
+
+        with patch('charmhelpers.core.hookenv.is_leader', return_value=False):
+            server.set_topology('host=10.0.0.1', ['host=10.0.0.2'], leader_only=True, legacy=False)
+        self.assertEqual(rel.to_publish_raw['topology'], '')
+
+    def test_set_topology_no_legacy(self):
+        rel = make_relation('db:1', {'client/0': {}})
+        make_server(rel).set_topology(None, legacy=False)
+        self.assertNotIn('master', rel.to_publish_raw)
+        self.assertIsNone(json.loads(rel.to_publish_raw['topology'])['master'])
+
+
+class TestClientRequests(unittest.TestCase):
+    def setUp(self):
+        kv = patch('charmhelpers.core.unitdata.kv', autospec=True)
+        self.kv = unitdata.Storage(':memory:')
+        kv.start().return_value = self.kv
+        self.addCleanup(kv.stop)
+        self.clients = {
+            'db:1': {'app1/0': {'database': 'mydb', 'roles': 'a,b',
+                                'egress-subnets': '10.0.0.1/32'},
+                     'app1/1': {'database': 'mydb', 'roles': 'a,b',
+                                'egress-subnets': '10.0.0.2/32'}},
+            'db:2': {'app2/0': {'database': 'otherdb', 'roles': 'b',
+                                'extensions': 'citext'}}}
+
+    def server(self):
+        return make_server(*[make_relation(relid, units)
+                             for relid, units in sorted(self.clients.items())])
+
+    def test_lookups(self):
+        requests = self.server().client_requests
+        self.assertEqual(requests.relids('database', 'mydb'), {'db:1'})
+        self.assertEqual(requests.relids('roles', 'b'), {'db:1', 'db:2'})
+        self.assertEqual(requests.relids('extensions', 'citext'), {'db:2'})
+        self.assertEqual(requests.relids('database', 'nodb'), set())
+        self.assertEqual(requests.values('egress-subnets', 'db:1'),
+                         {'10.0.0.1/32', '10.0.0.2/32'})
+        self.assertEqual(requests.values('database'), {'mydb', 'otherdb'})
+        self.assertEqual(list(requests), ['db:1', 'db:2'])
+
+    def test_incremental(self):
+        self.clients['db:0'] = {'app0/0': {'database': 'mydb'}}
+        self.server().client_requests  # Stored for the next hook
+
+        self.clients['db:2']['app2/0']['database'] = 'mydb'
+        del self.clients['db:1']
+        self.clients['db:3'] = {'app3/0': {'database': 'mydb'}}
+        server = self.server()
+        requests = provides.ClientRequests._load(
+            self.kv.get('endpoint.db.client-requests'))
+        # db:0 is unchanged, so not reindexed.
+        self.assertEqual(requests.refresh(server.relations), ['db:1', 'db:2', 'db:3'])
+        self.assertEqual(requests.refresh(server.relations), [])
+
+        requests = server.client_requests
+        self.assertEqual(requests.relids('database', 'mydb'), {'db:0', 'db:2', 'db:3'})
+        self.assertEqual(requests.relids('roles', 'a'), set())
+        self.assertNotIn('db:1', requests)
+
+
+class TestScale(unittest.TestCase):
+    def test_data_volume_linear(self):
+        results = bench_provides.run([1, 10, 50], units=2, repeat=1)
+        for hook_name in ('initial', 'steady'):
+            per_relation = {size: results[size][hook_name]['bytes'] / size for size in results}
+            self.assertEqual(len(set(per_relation.values())), 1, per_relation)
+
+    def test_check_scaling(self):
+        linear = {size: {'initial': dict(seconds=size * 0.01, bytes=size * 100),
+                         'steady': dict(seconds=size * 0.01, bytes=size * 100)}
+                  for size in (10, 1000)}
+        self.assertEqual(bench_provides.check_scaling(linear), [])
+        linear[1000]['steady']['seconds'] = 1000 * 1000 * 0.01
+        self.assertEqual(len(bench_provides.check_scaling(linear)), 1)
+
+    def test_check_scaling_adjacent(self):
+        # Fixed overhead at the smallest size hides quadratic growth
+        # between the larger sizes, unless adjacent sizes are compared.
+        seconds = {1: 10.01, 100: 11, 1000: 1010}
+        results = {size: {'initial': dict(seconds=seconds[size], bytes=size * 100),
+                          'steady': dict(seconds=0.01, bytes=size * 100)}
+                   for size in seconds}
+        failures = bench_provides.check_scaling(results)
+        self.assertEqual(len(failures), 1)
+        self.assertIn('from 100 to 1000', failures[0])
@@ -0,0 +1,102 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import stat
+import sys
+import tempfile
+from unittest.mock import ANY, patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+import replay_hooks
+from fake_relations import make_relation
+from test_requires import ClientTestCase, make_client, pg_reldata
+
+
+class TestHookRecorder(ClientTestCase):
+    use_kv = True
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'trace.jsonl')
+        env = dict(hook_name='db-relation-changed', relation_id='db:1', remote_unit='pg/0')
+        for name, value in env.items():
+            self.patch('charmhelpers.core.hookenv.{}'.format(name)).return_value = value
+        self.atexit = self.patch('charmhelpers.core.hookenv.atexit')
+
+    def hook(self):
+        client = make_client(make_relation('db:1', {'pg/0': pg_reldata('10.0.0.1', master='host=10.0.0.1')},
+                                           {'database': 'mydata'}))
+        client.register_triggers()
+        client._manage_flags()
+        replay_hooks.dispatch(client)
+        for (callback, *args), kwargs in self.atexit.call_args_list:
+            callback(*args, **kwargs)
+        self.atexit.reset_mock()
+        return client
+
+    def test_not_recording(self):
+        self.hook()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_record(self):
+        make_client().record_hooks(self.path)
+        self.hook()
+        self.hook()
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        first, second = replay_hooks.load(self.path)
+        self.assertEqual(first['hook'], 'db-relation-changed')
+        self.assertEqual(first['relations']['db:1']['local'], {'database': 'mydata'})
+        self.assertEqual(first['relations']['db:1']['units']['pg/0']['master'], 'host=10.0.0.1')
+        self.assertEqual(first['flags_before'], [])
+        self.assertEqual(second['flags_before'], first['flags'])
+        self.assertIn('db.master.available', first['flags'])
+        self.assertTrue(first['flag_changes']['db.master.changed'])
+        self.assertFalse(first['flag_changes']['endpoint.db.changed'])
+        self.assertNotIn('db.master.changed', second['flag_changes'])
+
+        make_client().record_hooks(None)
+        self.hook()
+        self.assertEqual(len(replay_hooks.load(self.path)), 2)
+
+    def test_handlers(self):
+        self.assertEqual(replay_hooks.HANDLERS, [
+            ('_joined', ['endpoint.{endpoint_name}.joined'], []),
+            ('_departed', ['{endpoint_name}.connected'], ['endpoint.{endpoint_name}.joined']),
+            ('_changed', ['endpoint.{endpoint_name}.changed'], []),
+        ])
+
+    def test_record_failure(self):
+        make_client().record_hooks(os.path.join(self.path, 'missing', 'trace.jsonl'))
+        with patch('charmhelpers.core.hookenv.log') as log:
+            self.hook()  # Does not raise
+        log.assert_called_once_with(ANY, 'WARNING')
+
+    def test_replay(self):
+        make_client().record_hooks(self.path)
+        self.hook()
+        self.hook()
+        records = replay_hooks.load(self.path)
+        results = replay_hooks.replay(records, repeat=2)
+        self.assertEqual([differences for _, _, differences in results], [[], []])
+
+        # Replaying different data produces different flags.
+        records[0]['relations']['db:1']['units']['pg/0']['allowed-units'] = 'other/0'
+        _, _, differences = replay_hooks.replay(records)[0]
+        self.assertIn(('db.master.available', True, False), differences)
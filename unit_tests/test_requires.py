@@ -13,34 +13,59 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import UserDict
+from collections import OrderedDict
+import json
+import os
 import os.path
+import pickle
+import stat
 import sys
+import tempfile
 import unittest
 from unittest.mock import patch
 
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 
+from charmhelpers.core import unitdata
+from charms.reactive import clear_flag, is_flag_set
+from charms.reactive.endpoints import KeyList
+
+from fake_relations import make_relation
+import provides
 import requires
 from requires import ConnectionString
 
 
-class TestConnectionStringConstructor(unittest.TestCase):
-    def setUp(self):
-        self.reldata = UserDict({'allowed-units': 'client/0 client/9 client/8',
-                                 'host': '10.9.8.7',
-                                 'port': '5433',
-                                 'database': 'mydata',
-                                 'user': 'mememe',
-                                 'password': 'secret'})
-        self.reldata.relname = 'relname'
-        self.reldata.relid = 'relname:42'
+def make_client(*relations):
+    client = requires.PostgreSQLClient('db')
+    client._relations = KeyList(relations, key_attr='relation_id')
+    client._profile = {}
+    return client
+
+
+def pg_reldata(host, **kw):
+    """Relation data from an authorized PostgreSQL unit."""
+    reldata = {'allowed-units': 'client/0',
+               'host': host,
+               'port': '5432',
+               'database': 'mydata',
+               'user': 'mememe',
+               'password': 'secret'}
+    reldata.update(kw)
+    return reldata
 
-        local_unit = self.patch('charmhelpers.core.hookenv.local_unit')
-        local_unit.return_value = 'client/9'
 
-        rels = self.patch('charmhelpers.context.Relations')
-        rels()['relname']['relname:42'].local = {'database': 'mydata'}
+class ClientTestCase(unittest.TestCase):
+    """Tests run as local_unit, with an in memory unitdata.kv() if use_kv."""
+    local_unit = 'client/0'
+    use_kv = False
+
+    def setUp(self):
+        local_unit = self.patch('charmhelpers.core.hookenv.local_unit')
+        local_unit.return_value = self.local_unit
+        if self.use_kv:
+            self.kv = unitdata.Storage(':memory:')
+            self.patch('charmhelpers.core.unitdata.kv').return_value = self.kv
 
     def patch(self, dotpath):
         patcher = patch(dotpath, autospec=True)
@@ -48,8 +73,27 @@ class TestConnectionStringConstructor(unittest.TestCase):
         self.addCleanup(patcher.stop)
         return mock
 
+
+class TestConnectionStringConstructor(ClientTestCase):
+    local_unit = 'client/9'
+
+    def setUp(self):
+        super().setUp()
+        self.reldata = {'allowed-units': 'client/0 client/9 client/8',
+                        'host': '10.9.8.7',
+                        'port': '5433',
+                        'database': 'mydata',
+                        'user': 'mememe',
+                        'password': 'secret'}
+        self.locdata = {'database': 'mydata'}
+
+    def cs(self):
+        relation = make_relation('relname:42', {'postgresql/0': self.reldata},
+                                 self.locdata)
+        return requires._cs(relation.joined_units['postgresql/0'])
+
     def test_normal(self):
-        conn_str = requires._cs(self.reldata)
+        conn_str = self.cs()
         self.assertIsNotNone(conn_str)
         self.assertIsInstance(conn_str, ConnectionString)
         self.assertEqual(conn_str,
@@ -58,16 +102,771 @@ class TestConnectionStringConstructor(unittest.TestCase):
 
     def test_missing_attr(self):
         del self.reldata['port']
-        self.assertIsNone(requires._cs(self.reldata))
+        self.assertIsNone(self.cs())
 
     def test_incorrect_database(self):
         self.reldata['database'] = 'notherdb'
-        self.assertIsNone(requires._cs(self.reldata))
+        self.assertIsNone(self.cs())
 
     def test_unauthorized(self):
         self.reldata['allowed-units'] = 'client/90'
-        self.assertIsNone(requires._cs(self.reldata))
+        self.assertIsNone(self.cs())
 
     def test_no_auth(self):
         del self.reldata['allowed-units']
-        self.assertIsNone(requires._cs(self.reldata))
+        self.assertIsNone(self.cs())
+
+    def test_allowed_subnets(self):
+        del self.reldata['allowed-units']
+        self.locdata['egress-subnets'] = '10.0.0.5/32, 192.168.1.0/24'
+        self.reldata['allowed-subnets'] = '192.168.1.0/24,10.0.0.5/32'
+        self.assertIsNotNone(self.cs())
+
+    def test_allowed_subnets_covering(self):
+        del self.reldata['allowed-units']
+        self.locdata['egress-subnets'] = '10.0.0.5/32,192.168.1.128/25'
+        self.reldata['allowed-subnets'] = '192.168.0.0/16,10.0.0.0/8'
+        self.assertIsNotNone(self.cs())
+
+    def test_allowed_subnets_partial(self):
+        del self.reldata['allowed-units']
+        self.locdata['egress-subnets'] = '10.0.0.5/32,192.168.1.0/24'
+        self.reldata['allowed-subnets'] = '10.0.0.0/8,192.168.1.0/25'
+        self.assertIsNone(self.cs())
+
+    def test_allowed_subnets_ipv6(self):
+        del self.reldata['allowed-units']
+        self.locdata['egress-subnets'] = '2001:db8::1/128'
+        self.reldata['allowed-subnets'] = '10.0.0.0/8,2001:db8::/32'
+        self.assertIsNotNone(self.cs())
+        self.reldata['allowed-subnets'] = '10.0.0.0/8,2001:db9::/32'
+        self.assertIsNone(self.cs())
+
+
+class TestSubnetIndex(unittest.TestCase):
+    def covers(self, index, name):
+        return index.covers(name, requires._ip_network(name))
+
+    def test_collapsed(self):
+        index = requires._SubnetIndex(['10.0.0.0/25', '10.0.0.128/25',
+                                       '10.0.1.0/24', '172.16.0.0/12'])
+        self.assertTrue(self.covers(index, '10.0.0.0/23'))
+        self.assertTrue(self.covers(index, '10.0.1.7/32'))
+        self.assertTrue(self.covers(index, '172.20.1.0/24'))
+        self.assertFalse(self.covers(index, '10.0.0.0/22'))
+        self.assertFalse(self.covers(index, '9.255.255.255/32'))
+        self.assertFalse(self.covers(index, '172.32.0.0/32'))
+
+    def test_many(self):
+        index = requires._SubnetIndex('10.{}.{}.0/24'.format(i // 256, i % 256)
+                                      for i in range(0, 1000, 2))
+        self.assertTrue(self.covers(index, '10.0.2.3/32'))
+        self.assertFalse(self.covers(index, '10.0.3.3/32'))
+        self.assertTrue(self.covers(index, '10.3.230.0/24'))
+
+    def test_unparsable(self):
+        index = requires._SubnetIndex(['not-a-subnet', '10.0.0.0/8'])
+        self.assertTrue(self.covers(index, 'not-a-subnet'))
+        self.assertFalse(self.covers(index, 'also-not-a-subnet'))
+        self.assertTrue(self.covers(index, '10.1.2.3'))
+
+
+class TestShardRouter(ClientTestCase):
+    def css(self, n):
+        css = []
+        for i in range(n):
+            reldata = {'allowed-units': 'client/0',
+                       'host': '10.0.0.{}'.format(i),
+                       'port': '5432',
+                       'database': 'mydata',
+                       'user': 'mememe',
+                       'password': 'secret',
+                       'state': 'master'}
+            relation = make_relation('db:{}'.format(i),
+                                     {'pg{}/0'.format(i): reldata})
+            css.append(requires.ConnectionStrings(relation))
+        return css
+
+    def test_empty(self):
+        router = requires.ShardRouter([])
+        self.assertEqual(len(router), 0)
+        with self.assertRaises(LookupError):
+            router.relid('key')
+
+    def test_routing(self):
+        router = requires.ShardRouter(self.css(3))
+        keys = ['key{}'.format(i) for i in range(3000)]
+        counts = {}
+        for key in keys:
+            relid = router.relid(key)
+            counts[relid] = counts.get(relid, 0) + 1
+            self.assertEqual(router[key].relid, relid)
+            self.assertEqual(router.master(key).host,
+                             '10.0.0.{}'.format(relid.split(':')[1]))
+        # Reasonably even distribution
+        self.assertEqual(sorted(counts.keys()), ['db:0', 'db:1', 'db:2'])
+        for count in counts.values():
+            self.assertGreater(count, 600)
+
+    def test_minimal_rebalance(self):
+        before = requires.ShardRouter(self.css(3))
+        after = requires.ShardRouter(self.css(4))
+        moved = 0
+        for i in range(3000):
+            key = 'key{}'.format(i)
+            if before.relid(key) != after.relid(key):
+                # Keys only move to the new service.
+                self.assertEqual(after.relid(key), 'db:3')
+                moved += 1
+        self.assertGreater(moved, 0)
+        self.assertLess(moved, 1200)
+
+    def test_unitless(self):
+        # Relations without units would otherwise be named after the
+        # local application, and collide on the ring.
+        css = self.css(2) + [requires.ConnectionStrings(make_relation('db:{}'.format(i), {}))
+                             for i in (2, 3)]
+        with patch('charmhelpers.core.hookenv.application_name', return_value='client'):
+            router = requires.ShardRouter(css)
+        self.assertEqual(len(router), 2)
+        for i in range(300):
+            self.assertIn(router.relid('key{}'.format(i)), ('db:0', 'db:1'))
+
+
+class TestStandbyStatus(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reldata = {'allowed-units': 'client/0',
+                        'host': '10.0.0.1',
+                        'port': '5432',
+                        'database': 'mydata',
+                        'user': 'mememe',
+                        'password': 'secret',
+                        'master': 'host=10.0.0.1',
+                        'standbys': 'host=10.0.0.2\nhost=10.0.0.3\nhost=10.0.0.4'}
+
+    def css(self):
+        relation = make_relation('db:1', {'postgresql/0': self.reldata})
+        return requires.ConnectionStrings(relation)
+
+    def test_no_status(self):
+        css = self.css()
+        self.assertEqual(css.standby_status, {})
+        self.assertEqual(css.standbys_within(10), css.standbys)
+
+    def test_standbys_within(self):
+        self.reldata['standby-status'] = json.dumps({
+            'host=10.0.0.2': dict(lag=2.0, healthy=True),
+            'host=10.0.0.3': dict(lag=60.0, healthy=True),
+            'host=10.0.0.4': dict(lag=0.0, healthy=False)})
+        css = self.css()
+        self.assertEqual(css.standby_status[ConnectionString('host=10.0.0.3')],
+                         dict(lag=60.0, healthy=True))
+        self.assertEqual(css.standbys_within(10), ['host=10.0.0.2'])
+        self.assertEqual(css.standbys_within(60),
+                         ['host=10.0.0.2', 'host=10.0.0.3'])
+        self.assertEqual(css.standbys_within(None),
+                         ['host=10.0.0.2', 'host=10.0.0.3'])
+
+
+class TestStandbyLocality(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.dict(os.environ, {'JUJU_AVAILABILITY_ZONE': 'us-east-1a'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1',
+                                  standbys='host=10.0.0.2\nhost=10.0.0.3\nhost=10.0.0.4\nhost=10.0.0.5')
+        self.reldata['locality'] = json.dumps({
+            'host=10.0.0.1': dict(zone='us-east-1a', region='us-east-1'),
+            'host=10.0.0.2': dict(zone='eu-west-1a', region='eu-west-1'),
+            'host=10.0.0.3': dict(zone='us-east-1b', region='us-east-1'),
+            'host=10.0.0.4': dict(zone='us-east-1a', region='us-east-1')})
+
+    def css(self):
+        return requires.ConnectionStrings(make_relation('db:1', {'pg/0': self.reldata}))
+
+    def test_no_locality(self):
+        del self.reldata['locality']
+        css = self.css()
+        self.assertEqual(css.standby_locality, {})
+        self.assertEqual(css.standbys_near(), sorted(css.standbys))
+        self.assertEqual(css.standbys_near(nearest=True), sorted(css.standbys))
+
+    def test_standbys_near(self):
+        css = self.css()
+        self.assertEqual(css.standby_locality[ConnectionString('host=10.0.0.2')],
+                         dict(zone='eu-west-1a', region='eu-west-1'))
+        # Local zone, then local region, then elsewhere or unknown.
+        self.assertEqual(css.standbys_near(),
+                         ['host=10.0.0.4', 'host=10.0.0.3', 'host=10.0.0.2', 'host=10.0.0.5'])
+        self.assertEqual(css.standbys_near(nearest=True), ['host=10.0.0.4'])
+        self.assertEqual(css.standbys_near(zone='eu-west-1a', nearest=True), ['host=10.0.0.2'])
+        self.assertEqual(css.standbys_near(zone='eu-west-1b', region='eu-west-1', nearest=True),
+                         ['host=10.0.0.2'])
+
+    def test_fallback(self):
+        # Unavailable local standbys fall back to the next closest.
+        self.reldata['standby-status'] = json.dumps({
+            'host=10.0.0.4': dict(lag=0.0, healthy=False)})
+        self.assertEqual(self.css().standbys_near(nearest=True), ['host=10.0.0.3'])
+
+    def test_client(self):
+        other = pg_reldata('10.0.1.1', standbys='host=10.0.1.2')
+        other['locality'] = json.dumps({'host=10.0.1.2': dict(zone='us-east-1a')})
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}),
+                             make_relation('db:2', {'pg/0': other}))
+        self.assertEqual(client.standbys_near(nearest=True),
+                         ['host=10.0.0.4', 'host=10.0.1.2'])
+        self.assertEqual(len(client.standbys_near()), 5)
+
+
+class TestClientFiles(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.reldata = pg_reldata('10.0.0.1',
+                                  master='host=10.0.0.1 port=5432 dbname=mydata user=mememe password=sec:ret',
+                                  standbys='host=10.0.0.3 port=5432 dbname=mydata user=mememe password=sec:ret\n'
+                                           'host=10.0.0.2 port=5432 dbname=mydata user=mememe password=sec:ret')
+
+    def client(self):
+        return make_client(make_relation('db:12', {'postgresql/0': self.reldata}))
+
+    def test_pg_services(self):
+        services = self.client().pg_services()
+        self.assertEqual(list(services.keys()),
+                         ['db-12-master', 'db-12-standby-0', 'db-12-standby-1'])
+        self.assertEqual(services['db-12-standby-0'].host, '10.0.0.2')
+
+    def test_write_pg_service_conf(self):
+        path = os.path.join(self.tmpdir.name, 'pg_service.conf')
+        self.assertTrue(self.client().write_pg_service_conf(path))
+        with open(path) as f:
+            content = f.read()
+        self.assertTrue(content.startswith('[db-12-master]\n'
+                                           'dbname=mydata\n'
+                                           'host=10.0.0.1\n'
+                                           'port=5432\n'
+                                           'user=mememe\n'))
+        self.assertIn('[db-12-standby-1]\n', content)
+        self.assertNotIn('password', content)
+
+        # Unchanged content is not rewritten.
+        mtime = os.stat(path).st_mtime_ns
+        self.assertFalse(self.client().write_pg_service_conf(path))
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+        del self.reldata['standbys']
+        self.assertTrue(self.client().write_pg_service_conf(path))
+        self.assertEqual(os.listdir(self.tmpdir.name), ['pg_service.conf'])
+
+    def test_write_pgpass(self):
+        path = os.path.join(self.tmpdir.name, 'pgpass')
+        self.assertTrue(self.client().write_pgpass(path))
+        with open(path) as f:
+            self.assertEqual(f.read(),
+                             '10.0.0.1:5432:mydata:mememe:sec\\:ret\n'
+                             '10.0.0.2:5432:mydata:mememe:sec\\:ret\n'
+                             '10.0.0.3:5432:mydata:mememe:sec\\:ret\n')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.assertFalse(self.client().write_pgpass(path))
+
+        # Loose permissions are corrected, even with unchanged content.
+        os.chmod(path, 0o644)
+        self.assertFalse(self.client().write_pgpass(path))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+
+class TestLookups(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = make_client(
+            make_relation('db:1', {'pg/0': pg_reldata('10.0.0.1', master='host=10.0.0.1')}),
+            make_relation('db:2', {'other/0': pg_reldata('10.0.1.1'),
+                                   'other/1': pg_reldata('10.0.1.2')}))
+
+    def test_getitem(self):
+        cs = self.client['db:2']
+        self.assertIsInstance(cs, requires.ConnectionStrings)
+        self.assertEqual(cs.relid, 'db:2')
+        self.assertEqual(sorted(cs.keys()), ['other/0', 'other/1'])
+        self.assertEqual(self.client['db:1'].master, 'host=10.0.0.1')
+        with self.assertRaises(KeyError):
+            self.client['db:3']
+
+    def test_cached(self):
+        cs = self.client['db:1']
+        self.assertIs(self.client['db:1'], cs)
+        self.assertIs(list(self.client)[0], cs)
+
+        # Relations replaced, such as by a new hook.
+        self.client._relations = KeyList([make_relation('db:1', {})], key_attr='relation_id')
+        self.assertIsNot(self.client['db:1'], cs)
+        with self.assertRaises(KeyError):
+            self.client['db:2']
+
+    def test_invalidated(self):
+        cs = self.client['db:1']
+        with patch('charmhelpers.core.unitdata.kv', return_value=unitdata.Storage(':memory:')):
+            self.client.set_database('mydata', relid='db:1')
+        self.assertEqual(self.client.relations['db:1'].to_publish_raw['database'], 'mydata')
+        self.assertIsNot(self.client['db:1'], cs)
+
+    def test_connection_string(self):
+        self.assertEqual(self.client.connection_string('other/1').host, '10.0.1.2')
+        self.assertEqual(self.client.connection_string('pg/0').host, '10.0.0.1')
+        with self.assertRaises(LookupError):
+            self.client.connection_string('nope/0')
+
+
+class TestMetrics(ClientTestCase):
+    use_kv = True
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('time.time', return_value=1000.5)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'pgsql.prom')
+        self.reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1',
+                                  standbys='host=10.0.0.2', version='10')
+        self.pending = pg_reldata('10.0.1.1', master='host=10.0.1.1')
+        self.pending['allowed-units'] = 'other/0'
+
+    def metrics(self):
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}),
+                             make_relation('db:2', {'pg/0': self.pending, 'pg/1': {}}))
+        written = client.write_metrics(self.path)
+        with open(self.path) as f:
+            return written, {line.rsplit(' ', 1)[0]: line.rsplit(' ', 1)[1]
+                             for line in f.read().splitlines() if not line.startswith('#')}
+
+    def test_metrics(self):
+        written, metrics = self.metrics()
+        self.assertTrue(written)
+        self.assertEqual(metrics, {
+            'pgsql_client_related_services{endpoint="db"}': '2',
+            'pgsql_client_master_available{endpoint="db",relid="db:1"}': '1',
+            'pgsql_client_master_available{endpoint="db",relid="db:2"}': '0',
+            'pgsql_client_standbys{endpoint="db",relid="db:1"}': '1',
+            'pgsql_client_standbys{endpoint="db",relid="db:2"}': '0',
+            'pgsql_client_version_info{endpoint="db",relid="db:1",version="10"}': '1',
+            'pgsql_client_authorization_pending_units{endpoint="db",relid="db:1"}': '0',
+            'pgsql_client_authorization_pending_units{endpoint="db",relid="db:2"}': '1',
+            'pgsql_client_master_last_change_timestamp_seconds{endpoint="db",relid="db:1"}': '1000',
+            'pgsql_client_master_last_change_timestamp_seconds{endpoint="db",relid="db:2"}': '1000',
+            'pgsql_client_master_changes_total{endpoint="db",relid="db:1"}': '0',
+            'pgsql_client_master_changes_total{endpoint="db",relid="db:2"}': '0',
+            'pgsql_client_standbys_last_change_timestamp_seconds{endpoint="db",relid="db:1"}': '1000',
+            'pgsql_client_standbys_last_change_timestamp_seconds{endpoint="db",relid="db:2"}': '1000',
+            'pgsql_client_standbys_changes_total{endpoint="db",relid="db:1"}': '0',
+            'pgsql_client_standbys_changes_total{endpoint="db",relid="db:2"}': '0'})
+
+    def test_changes(self):
+        self.metrics()
+        self.time.return_value = 2000
+        written, _ = self.metrics()
+        self.assertFalse(written)  # Unchanged, so not rewritten.
+
+        self.reldata['master'] = 'host=10.0.0.9'
+        written, metrics = self.metrics()
+        self.assertTrue(written)
+        labels = '{endpoint="db",relid="db:1"}'
+        self.assertEqual(metrics['pgsql_client_master_changes_total' + labels], '1')
+        self.assertEqual(metrics['pgsql_client_master_last_change_timestamp_seconds' + labels], '2000')
+        self.assertEqual(metrics['pgsql_client_standbys_changes_total' + labels], '0')
+        self.assertEqual(metrics['pgsql_client_standbys_last_change_timestamp_seconds' + labels], '1000')
+
+    def test_quote(self):
+        self.assertEqual(requires._prometheus_quote('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+class TestConvergence(ClientTestCase):
+    use_kv = True
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch('time.time', return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reldata = {}
+        self.local = {'database': 'mydata', 'roles': 'reader'}
+
+    def hook(self, now):
+        self.time.return_value = now
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}, self.local))
+        client._reset_all_flags()
+        return client
+
+    def test_reasons(self):
+        css = requires.ConnectionStrings(make_relation('db:1', {'pg/0': {}, 'pg/1': pg_reldata('10.0.0.1')}))
+        self.assertEqual(css.waiting_on, {'pg/0': 'details'})
+        self.assertEqual(css.state, 'details')
+        css = requires.ConnectionStrings(make_relation('db:1', {'pg/1': pg_reldata('10.0.0.1')}))
+        self.assertEqual(css.waiting_on, {})
+        self.assertEqual(css.state, 'no-master')
+        css = requires.ConnectionStrings(make_relation('db:1', {}))
+        self.assertEqual(css.state, 'connected')
+
+    def test_convergence(self):
+        client = self.hook(1000)
+        self.assertEqual(client.convergence()['db:1'].state, 'details')
+
+        self.reldata.update(pg_reldata('10.0.0.1', master='host=10.0.0.1'))
+        self.reldata['allowed-units'] = ''
+        self.hook(1010)
+        self.reldata['allowed-units'] = 'client/0'
+        self.hook(1030)
+        self.reldata['roles'] = 'reader'
+        self.hook(1060)
+        self.hook(1070)  # Unchanged
+
+        self.time.return_value = 1100
+        c = self.hook(1100).convergence()['db:1']
+        self.assertEqual(c.state, 'available')
+        self.assertEqual(c.since, 1060)
+        self.assertEqual(c.waiting_on, {})
+        self.assertEqual(c.entered, {'connected': 1000, 'details': 1000, 'authorization': 1010,
+                                     'roles': 1030, 'available': 1060})
+        self.assertEqual(c.durations, {'connected': 0, 'details': 10, 'authorization': 20,
+                                       'roles': 30, 'available': 40})
+        self.assertEqual(c.joined, 1000)
+        self.assertEqual(c.time_to_available, 60)
+
+    def test_waiting(self):
+        self.reldata.update(pg_reldata('10.0.0.1', master='host=10.0.0.1'))
+        self.reldata['database'] = 'other'
+        self.hook(1000)
+        self.time.return_value = 1005
+        c = self.hook(1005).convergence()['db:1']
+        self.assertEqual(c.state, 'database')
+        self.assertEqual(c.waiting_on, {'pg/0': 'database'})
+        self.assertEqual(c.durations, {'connected': 0, 'database': 5})
+        self.assertIsNone(c.time_to_available)
+
+    def test_from_joined(self):
+        self.time.return_value = 990
+        client = make_client(make_relation('db:1', {'pg/0': {}}, self.local))
+        client._joined()  # Before any data has changed
+        self.reldata.update(pg_reldata('10.0.0.1', master='host=10.0.0.1', roles='reader'))
+        c = self.hook(1000).convergence()['db:1']
+        self.assertEqual(c.state, 'available')
+        self.assertEqual(c.entered, {'connected': 990, 'details': 990, 'available': 1000})
+        self.assertEqual(c.joined, 990)
+        self.assertEqual(c.time_to_available, 10)
+
+
+class TestSnapshot(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.reldata = {
+            'db:1': pg_reldata('10.0.0.1', version='10',
+                               master='host=10.0.0.1',
+                               standbys='host=10.0.0.3\nhost=10.0.0.2'),
+            'db:2': pg_reldata('10.0.1.1', master='host=10.0.1.1')}
+
+    def snapshot(self):
+        return make_client(*[make_relation(relid, {'pg/0': reldata})
+                             for relid, reldata in sorted(self.reldata.items())]).snapshot()
+
+    def test_snapshot(self):
+        snap = self.snapshot()
+        self.assertEqual(snap, (
+            requires.RelationSnapshot('db:1', 'host=10.0.0.1',
+                                      ('host=10.0.0.2', 'host=10.0.0.3'), '10', True),
+            requires.RelationSnapshot('db:2', 'host=10.0.1.1', (), None, True)))
+        self.assertIs(type(snap.get('db:1').master), str)
+        self.assertIsNone(snap.get('db:3'))
+
+    def test_hash_and_pickle(self):
+        snap = self.snapshot()
+        self.assertEqual(hash(snap), hash(self.snapshot()))
+        self.assertEqual(pickle.loads(pickle.dumps(snap)), snap)
+        self.assertIsInstance(pickle.loads(pickle.dumps(snap)), requires.Snapshot)
+
+    def test_diff(self):
+        before = self.snapshot()
+        self.assertEqual(before.diff(self.snapshot()), [])
+        self.reldata['db:1']['allowed-units'] = ''
+        del self.reldata['db:2']
+        self.reldata['db:3'] = pg_reldata('10.0.2.1')
+        after = self.snapshot()
+        self.assertNotEqual(after, before)
+        self.assertFalse(after.get('db:1').authorized)
+        self.assertEqual(after.diff(before), ['db:1', 'db:2', 'db:3'])
+
+
+class TestTLSMaterial(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tlsdir = os.path.join(tmpdir.name, 'tls')
+        self.reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1',
+                                  standbys='host=10.0.0.2')
+        self.reldata['ssl-ca'] = 'CA PEM'
+        self.reldata['ssl-key'] = 'KEY PEM'
+
+    def client(self):
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}))
+        client.set_tls_dir(self.tlsdir)
+        return client
+
+    def test_paths(self):
+        client = self.client()
+        master = client.master
+        self.assertEqual(master.sslmode, 'verify-ca')
+        self.assertTrue(master.sslrootcert.startswith(self.tlsdir))
+        with open(master.sslrootcert) as f:
+            self.assertEqual(f.read(), 'CA PEM')
+        self.assertEqual(stat.S_IMODE(os.stat(master.sslkey).st_mode), 0o600)
+        self.assertNotIn('sslcert', master.keys())
+        standby = list(client.standbys)[0]
+        self.assertEqual(standby.sslrootcert, master.sslrootcert)
+        self.assertEqual(client.connection_string('pg/0').sslrootcert,
+                         master.sslrootcert)
+
+    def test_content_addressed(self):
+        master = self.client().master
+        mtime = os.stat(master.sslrootcert).st_mtime_ns
+        self.assertEqual(self.client().master, master)
+        self.assertEqual(os.stat(master.sslrootcert).st_mtime_ns, mtime)
+
+        self.reldata['ssl-ca'] = 'NEW CA PEM'
+        self.reldata['sslmode'] = 'verify-full'
+        client = self.client()
+        new_master = client.master
+        self.assertNotEqual(new_master.sslrootcert, master.sslrootcert)
+        self.assertEqual(new_master.sslmode, 'verify-full')
+        self.assertEqual(new_master.sslkey, master.sslkey)
+        self.assertEqual(client.prune_tls_material(), [master.sslrootcert])
+        self.assertEqual(sorted(os.listdir(self.tlsdir)),
+                         sorted(os.path.basename(p) for p in (new_master.sslrootcert,
+                                                              new_master.sslkey)))
+
+    def test_prune_leaves_other_files(self):
+        client = self.client()
+        self.assertTrue(client.master)
+        own = os.path.join(self.tlsdir, 'my-own-ca.pem')
+        with open(own, 'w') as f:
+            f.write('MINE')
+        self.assertEqual(client.prune_tls_material(), [])
+        self.assertTrue(os.path.exists(own))
+
+    def test_default_dir_per_endpoint(self):
+        charm_dir = os.path.dirname(self.tlsdir)
+        with patch('charmhelpers.core.hookenv.charm_dir', return_value=charm_dir):
+            db = make_client(make_relation('db:1', {'pg/0': self.reldata}))
+            admin = requires.PostgreSQLClient('db-admin')
+            admin._relations = KeyList([make_relation('db-admin:2', {'pg/0': self.reldata})],
+                                       key_attr='relation_id')
+            admin._profile = {}
+            master = db.master
+            self.assertEqual(os.path.dirname(master.sslrootcert),
+                             os.path.join(charm_dir, 'pgsql-tls', 'db'))
+            self.assertEqual(os.path.dirname(admin.master.sslrootcert),
+                             os.path.join(charm_dir, 'pgsql-tls', 'db-admin'))
+            admin._relations = KeyList([], key_attr='relation_id')
+            self.assertEqual(len(admin.prune_tls_material()), 2)
+            self.assertTrue(os.path.exists(master.sslrootcert))
+
+    def test_existing_file_permissions(self):
+        sslkey = self.client().master.sslkey
+        os.chmod(sslkey, 0o644)
+        self.assertEqual(self.client().master.sslkey, sslkey)
+        self.assertEqual(stat.S_IMODE(os.stat(sslkey).st_mode), 0o600)
+
+    @unittest.skipUnless(os.getuid() == 0, 'requires root to change ownership')
+    def test_existing_file_owner(self):
+        sslkey = self.client().master.sslkey
+        os.chown(sslkey, 1, 1)
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}))
+        client.set_tls_dir(self.tlsdir, owner='root', group='root')
+        self.assertEqual(client.master.sslkey, sslkey)
+        st = os.stat(sslkey)
+        self.assertEqual((st.st_uid, st.st_gid), (0, 0))
+
+    def test_asyncpg_kwargs(self):
+        kwargs = self.client().master.asyncpg_kwargs
+        self.assertNotIn('ssl', kwargs)
+        self.assertEqual(kwargs['host'], '10.0.0.1')
+
+    def test_shared_store(self):
+        css = requires.ConnectionStrings(make_relation('db:1', {'pg/0': self.reldata,
+                                                                'pg/1': self.reldata}))
+        self.assertEqual(css['pg/0'].sslrootcert, css['pg/1'].sslrootcert)
+        self.assertEqual(len(css._tls._paths), 2)
+
+
+class TestTopologyProtocol(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        requires._topology_cache.clear()
+        self.addCleanup(requires._topology_cache.clear)
+        # Server publishes v3 and, for older clients, v2 keys.
+        server_rel = make_relation('db:1', {'client/0': {}})
+        server = provides.PostgreSQLServer('db')
+        server._relations = KeyList([server_rel], key_attr='relation_id')
+        server.set_topology('host=10.0.0.1 dbname=mydata',
+                            ['host=10.0.0.2 dbname=mydata'], '10')
+        self.reldata = pg_reldata('10.0.0.1', **server_rel.to_publish_raw)
+        # Distinguish v3 results from the v2 fallback.
+        self.reldata['master'] = 'host=v2'
+        self.reldata['standbys'] = 'host=v2'
+
+    def css(self):
+        return requires.ConnectionStrings(make_relation('db:1', {'pg/0': self.reldata,
+                                                                 'pg/1': self.reldata}))
+
+    def test_topology(self):
+        css = self.css()
+        self.assertEqual(css.master, 'dbname=mydata host=10.0.0.1')
+        self.assertEqual(css.standbys, ['dbname=mydata host=10.0.0.2'])
+        self.assertEqual(css.version, '10')
+
+    def test_cached(self):
+        master = self.css().master
+        # The same instance, not reparsed.
+        self.assertIs(self.css().master, master)
+        self.assertEqual(len(requires._topology_cache), 1)
+
+    def test_hash_mismatch(self):
+        self.reldata['topology-hash'] = 'bad'
+        self.assertEqual(self.css().master, 'host=v2')
+
+    def test_fallback(self):
+        del self.reldata['topology']
+        self.assertEqual(self.css().master, 'host=v2')
+        self.assertEqual(self.css().standbys, ['host=v2'])
+
+    def test_leader_only(self):
+        reldata = {}
+        for unit, leader in [('pg/0', False), ('pg/1', True), ('pg/2', False)]:
+            server_rel = make_relation('db:1', {'client/0': {}})
+            server = provides.PostgreSQLServer('db')
+            server._relations = KeyList([server_rel], key_attr='relation_id')
+            with patch('charmhelpers.core.hookenv.is_leader', return_value=leader):
+                server.set_topology('host=10.0.0.1', ['host=10.0.0.2', 'host=10.0.0.3'], '10',
+                                    leader_only=True, member='host=' + unit)
+            reldata[unit] = pg_reldata('10.0.0.1', **server_rel.to_publish_raw)
+        self.assertEqual(reldata['pg/0']['topology'], '')
+        self.assertEqual(reldata['pg/0']['standbys'], '')
+        self.assertEqual(reldata['pg/0']['member'], 'host=pg/0')
+
+        css = requires.ConnectionStrings(make_relation('db:1', reldata))
+        self.assertEqual(css.master, 'host=10.0.0.1')
+        self.assertEqual(css.standbys, ['host=10.0.0.2', 'host=10.0.0.3'])
+        self.assertEqual(css.version, '10')
+
+        # Wait for members that have not yet authorized us.
+        reldata['pg/2']['allowed-units'] = ''
+        css = requires.ConnectionStrings(make_relation('db:1', reldata))
+        self.assertIsNone(css.master)
+
+    def test_leader_only_baseline_client(self):
+        def baseline_client(units):
+            # The v2 client logic before leader only mode. Juju unsets
+            # keys set to an empty string, so only non-empty values count.
+            units = {name: {k: v for k, v in d.items() if v} for name, d in units.items()}
+            authorized = all('client/0' in d.get('allowed-units', '').split()
+                             for d in units.values() if 'master' in d or 'standbys' in d)
+            master = next((d['master'] for d in units.values() if d.get('master')), None)
+            standbys = next((d['standbys'] for d in units.values() if d.get('standbys')), '')
+            return authorized, master, standbys.splitlines()
+
+        for master in ('host=10.0.0.1', None):
+            reldata = OrderedDict()
+            for unit, leader in [('pg/0', False), ('pg/1', True), ('pg/2', False)]:
+                server_rel = make_relation('db:1', {'client/0': {}})
+                server = provides.PostgreSQLServer('db')
+                server._relations = KeyList([server_rel], key_attr='relation_id')
+                with patch('charmhelpers.core.hookenv.is_leader', return_value=leader):
+                    server.set_topology(master, ['host=10.0.0.2', 'host=10.0.0.3'], '10',
+                                        leader_only=True, member='host=' + unit)
+                reldata[unit] = pg_reldata('10.0.0.1', **server_rel.to_publish_raw)
+            self.assertEqual(baseline_client(reldata),
+                             (True, master, ['host=10.0.0.2', 'host=10.0.0.3']))
+
+            # Old clients also wait for non-leaders to authorize them.
+            reldata['pg/2']['allowed-units'] = ''
+            self.assertFalse(baseline_client(reldata)[0])
+
+
+class TestConnectionProfiles(ClientTestCase):
+    use_kv = True
+
+    def setUp(self):
+        super().setUp()
+        self.patch('charmhelpers.core.hookenv.service_name').return_value = 'client'
+        self.patch('requires.PostgreSQLClient._reset_all_flags')
+        self.reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1 connect_timeout=99',
+                                  standbys='host=10.0.0.2')
+
+    def client(self):
+        client = make_client(make_relation('db:1', {'pg/0': self.reldata}))
+        client._profile = None
+        return client
+
+    def test_no_profile(self):
+        self.assertEqual(self.client().master, 'connect_timeout=99 host=10.0.0.1')
+
+    def test_profile(self):
+        self.client().set_profile('oltp-low-latency', connect_timeout=5,
+                                  keepalives_count=None, target_session_attrs='read-write')
+        client = self.client()  # Stored for subsequent hooks
+        master = client.master
+        self.assertEqual(master.application_name, 'client')
+        self.assertEqual(master.connect_timeout, '5')
+        self.assertEqual(master.keepalives_idle, '10')
+        self.assertEqual(master.target_session_attrs, 'read-write')
+        self.assertNotIn('keepalives_count', master.keys())
+        standby = list(client.standbys)[0]
+        self.assertEqual(standby.keepalives_idle, '10')
+        self.assertNotIn('target_session_attrs', standby.keys())
+
+    def test_standbys_within(self):
+        self.reldata['standby-status'] = json.dumps({'host=10.0.0.2': dict(lag=60)})
+        client = self.client()
+        client.set_profile('batch-etl')
+        self.assertEqual(client.standbys_within(10), set())
+
+    def test_unset(self):
+        client = self.client()
+        client.set_profile('batch-etl')
+        client.set_profile(None)
+        self.assertEqual(self.client().profile, {})
+
+    def test_unknown(self):
+        with self.assertRaises(KeyError):
+            self.client().set_profile('turbo')
+
+    def test_newer_libpq_opt_in(self):
+        # Need libpq 10 and 12 or later, so are not set by default.
+        for name in requires.CONNECTION_PROFILES:
+            self.client().set_profile(name)
+            self.assertNotIn('target_session_attrs', self.client().master.keys())
+            self.assertNotIn('tcp_user_timeout', self.client().master.keys())
+        self.client().set_profile('oltp-low-latency', target_session_attrs='read-write',
+                                  tcp_user_timeout=10000)
+        self.assertEqual(self.client().master.target_session_attrs, 'read-write')
+        self.assertEqual(self.client().master.tcp_user_timeout, '10000')
+
+    @patch('charmhelpers.core.hookenv.hook_name', return_value='db-relation-changed')
+    def test_changed_flags(self, hook_name):
+        client = self.client()
+        client._changed()
+        for flag in ('db.master.changed', 'db.standbys.changed', 'db.database.changed'):
+            self.assertTrue(is_flag_set(flag))
+            clear_flag(flag)
+        client.set_profile('batch-etl')
+        for flag in ('db.master.changed', 'db.standbys.changed', 'db.database.changed'):
+            self.assertTrue(is_flag_set(flag))
+            clear_flag(flag)
+        # Unchanged connection strings raise no flags.
+        client.set_profile('batch-etl')
+        self.assertFalse(is_flag_set('db.master.changed'))
+        self.assertFalse(is_flag_set('db.standbys.changed'))
@@ -0,0 +1,399 @@
+# Copyright 2018 Canonical Ltd.
+#
+# This file is part of the PostgreSQL Client Interface for Juju charms.reactive
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+import requires
+import topology
+from fake_relations import make_relation
+from test_requires import ClientTestCase, make_client, pg_reldata
+
+
+class TestTopology(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'pgsql.json')
+        self.reldata = pg_reldata('10.0.0.1', version='10',
+                                  master='host=10.0.0.1 dbname=mydata',
+                                  standbys='host=10.0.0.2 dbname=mydata')
+
+    def publish(self):
+        client = make_client(make_relation('db:1', {'postgresql/0': self.reldata}))
+        return client.publish_topology(self.path)
+
+    def test_format(self):
+        self.assertEqual(topology.FORMAT, requires.TOPOLOGY_FORMAT)
+
+    def test_publish_and_load(self):
+        self.assertTrue(self.publish())
+        topo = topology.load(self.path)
+        self.assertEqual(topo.generation, 1)
+        self.assertEqual(topo.services,
+                         {'db:1': topology.Service('dbname=mydata host=10.0.0.1',
+                                                   ('dbname=mydata host=10.0.0.2',),
+                                                   '10')})
+        self.assertEqual(topo.master, 'dbname=mydata host=10.0.0.1')
+        self.assertEqual(topo.standbys, {'dbname=mydata host=10.0.0.2'})
+
+        # Unchanged topology is not republished.
+        self.assertFalse(self.publish())
+        self.assertEqual(topology.load(self.path).generation, 1)
+
+        self.reldata['master'] = 'host=10.0.0.2 dbname=mydata'
+        self.reldata['standbys'] = ''
+        self.assertTrue(self.publish())
+        topo = topology.load(self.path)
+        self.assertEqual(topo.generation, 2)
+        self.assertEqual(topo.master, 'dbname=mydata host=10.0.0.2')
+        self.assertEqual(topo.standbys, set())
+
+    def test_watcher(self):
+        seen = []
+        watcher = topology.TopologyWatcher(self.path, seen.append)
+        self.assertFalse(watcher.check())  # No file yet
+        self.publish()
+        self.assertTrue(watcher.check())
+        self.assertFalse(watcher.check())
+        self.assertEqual(watcher.current.generation, 1)
+
+        self.reldata['master'] = 'host=10.0.0.2 dbname=mydata'
+        self.publish()
+        self.assertTrue(watcher.check())
+        self.assertEqual([t.generation for t in seen], [1, 2])
+        self.assertIs(watcher.current, seen[-1])
+
+    def test_watcher_ignores_invalid(self):
+        self.publish()
+        watcher = topology.TopologyWatcher(self.path)
+        self.assertTrue(watcher.check())
+        with open(self.path, 'w') as f:
+            f.write('{"format": 999}')
+        self.assertFalse(watcher.check())
+        self.assertEqual(watcher.current.generation, 1)
+
+    def test_watcher_callback_failure(self):
+        self.publish()
+        callback = MagicMock(side_effect=[RuntimeError('boom'), None])
+        watcher = topology.TopologyWatcher(self.path, callback)
+        with self.assertRaises(RuntimeError):
+            watcher.check()
+        self.assertIsNone(watcher.current)
+        # The change is reported again.
+        self.assertTrue(watcher.check())
+        self.assertEqual(watcher.current.generation, 1)
+        self.assertEqual(callback.call_count, 2)
+
+    def test_watcher_thread_survives_errors(self):
+        self.publish()
+        seen = []
+
+        def callback(topo):
+            seen.append(topo)
+            if len(seen) == 1:
+                raise RuntimeError('boom')
+
+        watcher = topology.TopologyWatcher(self.path, callback, interval=0.01)
+        with patch('topology.load', side_effect=[PermissionError(self.path), topology.load(self.path),
+                                                 topology.load(self.path)]):
+            with self.assertLogs('topology', 'ERROR') as logs:
+                watcher._stop.clear()
+                watcher._thread = threading.Thread(target=watcher._run, daemon=True)
+                watcher._thread.start()
+                for _ in range(100):
+                    if watcher.current is not None:
+                        break
+                    time.sleep(0.01)
+                watcher.stop()
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(watcher.current.generation, 1)
+
+
+class TestTopologyTable(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'pgsql.table')
+        self.reldata = pg_reldata('10.0.0.1',
+                                  master='host=10.0.0.1 dbname=mydata',
+                                  standbys='host=10.0.0.3\nhost=10.0.0.2')
+
+    def publish(self, **kw):
+        client = make_client(make_relation('db:1', {'postgresql/0': self.reldata}))
+        return client.publish_topology_table(self.path, **kw)
+
+    def test_layout(self):
+        self.assertEqual(topology.TABLE_MAGIC, requires.TOPOLOGY_TABLE_MAGIC)
+        self.assertEqual(topology.TABLE_LAYOUT, requires.TOPOLOGY_TABLE_LAYOUT)
+        self.assertEqual(topology._table_header.format, requires._table_header.format)
+        self.assertEqual(topology._table_entry.format, requires._table_entry.format)
+
+    def test_read(self):
+        self.assertTrue(self.publish())
+        table = topology.TopologyTable(self.path)
+        self.addCleanup(table.close)
+        topo = table.read()
+        self.assertEqual(topo.generation, table.generation)
+        self.assertEqual(topo.master, 'dbname=mydata host=10.0.0.1')
+        self.assertEqual(topo.services['db:1'].standbys,
+                         ('host=10.0.0.2', 'host=10.0.0.3'))
+
+    def test_update_in_place(self):
+        self.publish()
+        table = topology.TopologyTable(self.path)
+        self.addCleanup(table.close)
+        generation = table.generation
+
+        self.assertFalse(self.publish())
+        self.assertEqual(table.generation, generation)
+
+        self.reldata['master'] = 'host=10.0.0.2 dbname=mydata'
+        self.reldata['standbys'] = 'host=10.0.0.3'
+        self.assertTrue(self.publish())
+        # The existing mapping sees the change.
+        self.assertEqual(table.generation, generation + 2)
+        topo = table.read()
+        self.assertEqual(topo.master, 'dbname=mydata host=10.0.0.2')
+        self.assertEqual(topo.standbys, {'host=10.0.0.3'})
+
+    def test_relayout(self):
+        self.publish()
+        table = topology.TopologyTable(self.path)
+        self.addCleanup(table.close)
+        self.assertFalse(table.retired)
+        self.reldata['standbys'] = ''
+        self.assertTrue(self.publish(slots=8))
+        self.assertTrue(table.retired)
+        self.assertEqual(table.read().standbys, set())
+        self.assertFalse(table.retired)
+
+    def test_update_in_progress(self):
+        self.publish()
+        table = topology.TopologyTable(self.path)
+        self.addCleanup(table.close)
+        with open(self.path, 'r+b') as f:
+            f.seek(requires._table_generation_offset)
+            f.write(requires._table_generation.pack(table.generation + 1))
+        with self.assertRaises(TimeoutError):
+            table.read(timeout=0.01)
+        # The next update by the charm completes it.
+        self.reldata['standbys'] = ''
+        self.assertTrue(self.publish())
+        self.assertEqual(table.generation % 2, 0)
+        self.assertEqual(table.read().standbys, set())
+
+    def test_too_many(self):
+        with self.assertRaises(ValueError):
+            self.publish(slots=2)
+
+
+class FakePool(object):
+    """Stands in for an async driver's connection pool."""
+    def __init__(self, conn_str, in_flight=0.0):
+        self.conn_str = conn_str
+        self.in_flight = in_flight
+        self.closed = False
+
+    async def close(self):
+        await asyncio.sleep(self.in_flight)  # In-flight work completing.
+        self.closed = True
+
+
+class TestAsyncPoolManager(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.in_flight = 0.0
+        self.attempts = {}
+        self.flaky = 0  # Failures before flaky pools open.
+
+    async def open_pool(self, conn_str):
+        await asyncio.sleep(0)
+        self.attempts[conn_str] = self.attempts.get(conn_str, 0) + 1
+        if 'broken' in conn_str:
+            raise ConnectionError(conn_str)
+        if 'flaky' in conn_str and self.attempts[conn_str] <= self.flaky:
+            raise ConnectionError(conn_str)
+        pool = FakePool(conn_str, self.in_flight)
+        self.opened.append(pool)
+        return pool
+
+    def topo(self, master, standbys, generation=1):
+        return topology.Topology(generation, {
+            'db:1': topology.Service(master, tuple(standbys), '10')})
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_routing(self):
+        async def test():
+            pools = topology.AsyncPoolManager(self.open_pool)
+            self.assertEqual(await pools.update(self.topo('host=m', ['host=s1', 'host=s2'])), [])
+            self.assertEqual(pools.master().conn_str, 'host=m')
+            self.assertEqual(pools.master('db:1').conn_str, 'host=m')
+            picked = {pools.standby().conn_str for _ in range(4)}
+            self.assertEqual(picked, {'host=s1', 'host=s2'})
+            with self.assertRaises(LookupError):
+                pools.master('db:2')
+            await pools.close()
+            self.assertTrue(all(p.closed for p in self.opened))
+        self.run_async(test())
+
+    def test_fallback(self):
+        async def test():
+            pools = topology.AsyncPoolManager(self.open_pool)
+            await pools.update(self.topo('host=m', []))
+            self.assertEqual(pools.standby().conn_str, 'host=m')
+            with self.assertRaises(LookupError):
+                pools.standby(fallback=False)
+            await pools.close()
+        self.run_async(test())
+
+    def test_change(self):
+        async def test():
+            self.in_flight = 0.01
+            pools = topology.AsyncPoolManager(self.open_pool)
+            await pools.update(self.topo('host=m', ['host=s1', 'host=s2']))
+            master, s1, s2 = self.opened
+            await pools.update(self.topo('host=m', ['host=s2', 'host=s3'], 2))
+            # Unchanged pools are kept, and new ones routed to at once.
+            self.assertIs(pools.master(), master)
+            self.assertEqual(sorted(pools.pools), ['host=m', 'host=s2', 'host=s3'])
+            self.assertEqual({pools.standby().conn_str for _ in range(4)}, {'host=s2', 'host=s3'})
+            # Old pools drain in the background.
+            self.assertFalse(s1.closed)
+            await asyncio.sleep(0.05)
+            self.assertTrue(s1.closed)
+            self.assertFalse(s2.closed or master.closed)
+            await pools.close()
+        self.run_async(test())
+
+    def test_drain_timeout(self):
+        async def test():
+            self.in_flight = 10
+            pools = topology.AsyncPoolManager(self.open_pool, drain_timeout=0.01)
+            await pools.update(self.topo('host=m', []))
+            await pools.close()  # Does not wait for in-flight work.
+            self.assertFalse(self.opened[0].closed)
+        self.run_async(test())
+
+    def test_open_failure(self):
+        async def test():
+            pools = topology.AsyncPoolManager(self.open_pool)
+            failed = await pools.update(self.topo('host=m', ['host=broken', 'host=s1']))
+            self.assertEqual(failed, ['host=broken'])
+            self.assertEqual({pools.standby().conn_str for _ in range(4)}, {'host=s1'})
+            await pools.close()
+        self.run_async(test())
+
+    def test_retry_backoff(self):
+        now = [100.0]
+
+        async def test():
+            self.flaky = 2
+            pools = topology.AsyncPoolManager(self.open_pool, retry_interval=10,
+                                              clock=lambda: now[0])
+            topo = self.topo('host=m', ['host=flaky'])
+            self.assertEqual(await pools.update(topo), ['host=flaky'])
+            # Not retried until the backoff has passed.
+            now[0] = 109.9
+            self.assertEqual(await pools.update(topo), ['host=flaky'])
+            self.assertEqual(self.attempts['host=flaky'], 1)
+            now[0] = 110
+            self.assertEqual(await pools.update(topo), ['host=flaky'])
+            self.assertEqual(self.attempts['host=flaky'], 2)
+            # The backoff doubles.
+            now[0] = 129.9
+            self.assertTrue(pools._failed)
+            self.assertFalse(pools._retry_due())
+            await pools.update(topo)
+            self.assertEqual(self.attempts['host=flaky'], 2)
+            now[0] = 130
+            self.assertTrue(pools._retry_due())
+            self.assertEqual(await pools.update(topo), [])
+            self.assertEqual(pools.standby().conn_str, 'host=flaky')
+            self.assertEqual(self.attempts['host=m'], 1)
+            await pools.close()
+        self.run_async(test())
+
+    def test_retry_max(self):
+        now = [0.0]
+
+        async def test():
+            self.flaky = 10
+            pools = topology.AsyncPoolManager(self.open_pool, retry_interval=10,
+                                              retry_max=25, clock=lambda: now[0])
+            topo = self.topo('host=m', ['host=flaky'])
+            for expected in (10, 20, 25, 25):
+                await pools.update(topo)
+                self.assertEqual(pools._failed['host=flaky'][1], now[0] + expected)
+                now[0] += expected
+            await pools.close()
+        self.run_async(test())
+
+    def test_watch(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'pgsql.json')
+        with patch('charmhelpers.core.hookenv.local_unit', return_value='client/0'):
+            reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1', standbys='host=10.0.0.2')
+            make_client(make_relation('db:1', {'pg/0': reldata})).publish_topology(path)
+
+        async def test():
+            pools = topology.AsyncPoolManager(self.open_pool)
+            task = asyncio.ensure_future(pools.watch(path, interval=0.01))
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if pools.current is not None:
+                    break
+            task.cancel()
+            self.assertEqual(pools.master().conn_str, 'host=10.0.0.1')
+            self.assertEqual(pools.standby().conn_str, 'host=10.0.0.2')
+            await pools.close()
+        self.run_async(test())
+
+    def test_watch_retries(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'pgsql.json')
+        with patch('charmhelpers.core.hookenv.local_unit', return_value='client/0'):
+            reldata = pg_reldata('10.0.0.1', master='host=10.0.0.1', standbys='host=flaky')
+            make_client(make_relation('db:1', {'pg/0': reldata})).publish_topology(path)
+
+        async def test():
+            self.flaky = 2
+            pools = topology.AsyncPoolManager(self.open_pool, retry_interval=0.01)
+            task = asyncio.ensure_future(pools.watch(path, interval=0.01))
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if 'host=flaky' in pools.pools:
+                    break
+            task.cancel()
+            # Retried without the topology changing.
+            self.assertEqual(self.attempts['host=flaky'], 3)
+            self.assertEqual(pools.standby(fallback=False).conn_str, 'host=flaky')
+            await pools.close()
+        self.run_async(test())